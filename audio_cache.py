@@ -0,0 +1,57 @@
+# In-memory cache of the prompt audio in static/audio.
+#
+# The prompt set is small and only changes on deploy, so every file is read
+# once at startup into an immutable bytes buffer with a strong ETag derived
+# from its content. Requests are then answered without touching the disk,
+# and werkzeug handles conditional GETs (304) and byte ranges (206).
+
+import hashlib
+import logging
+import os
+
+from flask import Response
+
+logger = logging.getLogger(__name__)
+
+
+class AudioFile:
+    __slots__ = ("filename", "data", "etag", "mimetype")
+
+    def __init__(self, filename, data, mimetype):
+        self.filename = filename
+        self.data = data
+        self.etag = hashlib.sha256(data).hexdigest()[:32]
+        self.mimetype = mimetype
+
+
+class AudioCache:
+    def __init__(self, directory, extensions=(".mp3",), mimetype="audio/mpeg", max_age=86400):
+        self.directory = directory
+        self.extensions = extensions
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.files = {}
+
+    def load(self):
+        files = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(self.extensions):
+                continue
+            with open(os.path.join(self.directory, filename), "rb") as f:
+                files[filename] = AudioFile(filename, f.read(), self.mimetype)
+        self.files = files
+        logger.info(f"Loaded {len(files)} audio files ({sum(len(a.data) for a in files.values())} bytes) into memory")
+        return self
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def get(self, filename):
+        return self.files.get(filename)
+
+    def response(self, audio, request):
+        response = Response(audio.data, mimetype=audio.mimetype)
+        response.set_etag(audio.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(audio.data))
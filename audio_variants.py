@@ -0,0 +1,196 @@
+# Telephony renditions of the prompt audio.
+#
+# SIP bridges play 8 kHz mu-law, A-law or 16-bit linear PCM, and transcoding
+# an MP3 on every play costs CPU and playback latency on the telephony side.
+# Each MP3 loaded by the AudioCache is transcoded once per configured variant
+# with ffmpeg into a mono WAV file. The result is kept on disk under the
+# source's content hash, "<source etag>-<variant>.wav", so an unchanged file
+# is never transcoded twice, whichever worker or restart asks for it, and an
+# edited file gets fresh renditions. Renditions of sources that are no longer
+# loaded are deleted. Like the MP3s, the renditions are served from memory.
+#
+# Transcoding is meant to run once per deploy, before starting the workers:
+#     python audio_variants.py
+# A worker only reads the renditions already on disk at startup. Those still
+# missing are built by a background thread; until it is done, callers get
+# the MP3 for them.
+#
+# Variants are named "<codec>_<sample rate>", e.g. ulaw_8000 or pcm_16000.
+# Without ffmpeg no rendition is built and callers get the MP3 instead.
+
+import logging
+import os
+import shutil
+import subprocess
+import threading
+
+from werkzeug.http import parse_options_header
+
+from audio_cache import AudioFile
+
+logger = logging.getLogger(__name__)
+
+ORIGINAL = "mp3"
+
+# codec -> (ffmpeg encoder, media types that ask for it in an Accept header)
+CODECS = {
+    "ulaw": ("pcm_mulaw", ("audio/basic", "audio/pcmu")),
+    "alaw": ("pcm_alaw", ("audio/pcma",)),
+    "pcm": ("pcm_s16le", ("audio/l16",)),
+}
+
+MIMETYPE = "audio/wav"
+
+
+def parse_variant(name):
+    codec, _, rate = name.partition("_")
+    if codec not in CODECS or not rate.isdigit():
+        raise ValueError(f"Unknown audio variant '{name}', expected <{'|'.join(CODECS)}>_<sample rate>")
+    return codec, int(rate)
+
+
+# File name a rendition is served under, e.g. greeting.mp3 -> greeting.wav
+def variant_filename(filename):
+    return f"{os.path.splitext(filename)[0]}.wav"
+
+
+class AudioVariants:
+    def __init__(self, audio_cache, directory, names, ffmpeg="ffmpeg", timeout=30.0):
+        self.audio_cache = audio_cache
+        self.directory = directory
+        self.formats = {name: parse_variant(name) for name in names}
+        self.ffmpeg = ffmpeg
+        self.timeout = timeout
+        # (variant, served file name) -> AudioFile; replaced, never mutated
+        self.files = {}
+        self.missing = 0
+        self._thread = None
+
+    def __contains__(self, name):
+        return name == ORIGINAL or name in self.formats
+
+    # Read the renditions already on disk, without running ffmpeg
+    def load(self):
+        self._collect(transcode=False)
+        logger.info(f"Loaded {len(self.files)} telephony audio renditions, {self.missing} not built yet")
+        return self
+
+    # Transcode the missing renditions and drop stale ones
+    def build(self):
+        if not self.formats:
+            return self
+        if shutil.which(self.ffmpeg) is None:
+            logger.warning(f"ffmpeg not found at '{self.ffmpeg}', serving MP3 only")
+            return self
+        os.makedirs(self.directory, exist_ok=True)
+        keep, transcoded = self._collect(transcode=True)
+        self._prune(keep)
+        logger.info(f"Loaded {len(self.files)} telephony audio renditions, {transcoded} newly transcoded")
+        return self
+
+    # Build the missing renditions in a background thread; on_ready is called
+    # once they are being served
+    def start(self, on_ready=None):
+        if not self.missing:
+            return self
+        self._thread = threading.Thread(target=self._build_in_background, args=(on_ready,),
+                                        name="audio-variants", daemon=True)
+        self._thread.start()
+        return self
+
+    def _build_in_background(self, on_ready):
+        try:
+            self.build()
+            if on_ready is not None:
+                on_ready()
+        except Exception as e:
+            logger.error(f"Error building telephony audio renditions: {e}")
+
+    # Returns (cache file names in use, renditions transcoded)
+    def _collect(self, transcode):
+        files = {}
+        keep = set()
+        transcoded = 0
+        missing = 0
+        for source in self.audio_cache.files.values():
+            for name in self.formats:
+                path = os.path.join(self.directory, f"{source.etag}-{name}.wav")
+                keep.add(os.path.basename(path))
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    data = self._transcode(source, name, path) if transcode else None
+                    if data is None:
+                        missing += 1
+                        continue
+                    transcoded += 1
+                served = variant_filename(source.filename)
+                files[(name, served)] = AudioFile(f"{name}/{served}", data, MIMETYPE)
+        self.files = files
+        self.missing = missing
+        return keep, transcoded
+
+    def _transcode(self, source, name, path):
+        codec, rate = self.formats[name]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        command = [self.ffmpeg, "-v", "error", "-y", "-i", "pipe:0", "-map_metadata", "-1", "-bitexact",
+                   "-ac", "1", "-ar", str(rate), "-c:a", CODECS[codec][0], "-f", "wav", tmp_path]
+        try:
+            subprocess.run(command, input=source.data, capture_output=True, timeout=self.timeout, check=True)
+            with open(tmp_path, "rb") as f:
+                data = f.read()
+            # Other workers may be transcoding the same file; the last rename wins
+            os.replace(tmp_path, path)
+            return data
+        except (OSError, subprocess.SubprocessError) as e:
+            stderr = getattr(e, "stderr", None)
+            detail = stderr.decode("utf-8", "replace").strip() if stderr else e
+            logger.error(f"Error transcoding {source.filename} to {name}: {detail}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+
+    # Drop renditions of audio that changed or was removed
+    def _prune(self, keep):
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".wav") and filename not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+
+    # Rendition of a source file, or None if it could not be built
+    def get(self, name, filename):
+        return self.files.get((name, variant_filename(filename)))
+
+    # First variant, or the original, named in an Accept header, in order of
+    # preference; None when it names no audio type this server has
+    def negotiate(self, accept):
+        for value, quality in accept:
+            if not quality:
+                continue
+            mimetype, params = parse_options_header(value)
+            mimetype = mimetype.lower()
+            if mimetype == self.audio_cache.mimetype:
+                return ORIGINAL
+            for codec, (_, mimetypes) in CODECS.items():
+                if mimetype in mimetypes:
+                    name = f"{codec}_{params.get('rate', '8000')}"
+                    if name in self.formats:
+                        return name
+        return None
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from audio_cache import AudioCache
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    names = [name.strip() for name in os.getenv("AUDIO_VARIANTS", "ulaw_8000,pcm_8000").split(",") if name.strip()]
+    AudioVariants(AudioCache("static/audio/").load(), os.getenv("AUDIO_VARIANT_DIR", os.path.join("cache", "audio")),
+                  names, ffmpeg=os.getenv("AUDIO_FFMPEG", "ffmpeg")).build()
@@ -0,0 +1,154 @@
+# Load test for /process_text_mp3.
+#
+# Runs many concurrent scripted calls, each with its own uuid, against the app
+# served by an in-process threaded server backed by the MySQL stand-in (or
+# against an already running server with --target). Reports throughput and
+# p50/p95/p99 end to end and, for the in-process server, per pipeline stage.
+#
+# Run from the repository root:
+#     python benchmarks/bench_load.py --calls 2000 --concurrency 50
+#     python benchmarks/bench_load.py --save load.json
+#     python benchmarks/bench_load.py --baseline load.json --max-regression 0.2
+
+import argparse
+import http.client
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from harness import (CONVERSATION_SCRIPTS, StageTimer, compare_with_baseline, import_main, print_summary,
+                     save_results)
+
+
+def instrument(main, timer):
+    main.request_logger.log = timer.wrap("log_request", main.request_logger.log)
+    main.map_user_input = timer.wrap("map_user_input", main.map_user_input)
+    # Every campaign's flow is a ConversationFlow, so patching the class
+    # times them all
+    flow_class = type(main.campaign_store.get().flow)
+    flow_class.advance = timer.wrap("state_machine", flow_class.advance)
+    main.handle_conversation_turn = timer.wrap("conversation_turn", main.handle_conversation_turn)
+    main.save_log_to_db = timer.wrap("save_log_to_db", main.save_log_to_db)
+    main.log_writer._flush = timer.wrap("db_flush", main.log_writer._flush)
+
+
+def start_server(main):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    # Headers and body go out in separate writes; without TCP_NODELAY every
+    # turn waits on the client's delayed ACK
+    class RequestHandler(WSGIRequestHandler):
+        disable_nagle_algorithm = True
+
+    # One access log line per turn would dominate the console and the timings
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, main.app, threaded=True, request_handler=RequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def run_calls(target, calls, concurrency, seed, timer):
+    parts = urlsplit(target)
+    counter = iter(range(calls))
+    counter_lock = threading.Lock()
+    errors = []
+
+    def worker(worker_id):
+        rnd = random.Random(seed + worker_id)
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        while True:
+            with counter_lock:
+                call_id = next(counter, None)
+            if call_id is None:
+                break
+            session_uuid = f"bench-{seed}-{call_id}"
+            number = f"555{call_id:07d}"
+            for text in rnd.choice(CONVERSATION_SCRIPTS):
+                body = json.dumps({"text": text, "uuid": session_uuid, "number": number})
+                start = time.perf_counter()
+                try:
+                    connection.request("POST", "/process_text_mp3", body, {"Content-Type": "application/json"})
+                    response = connection.getresponse()
+                    payload = json.loads(response.read())
+                except (OSError, http.client.HTTPException, ValueError) as e:
+                    errors.append(f"{session_uuid}: {e}")
+                    connection.close()
+                    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+                    continue
+                timer.record("request", time.perf_counter() - start)
+                # Prompts without recorded audio answer 500 with a response text
+                if "response" not in payload:
+                    errors.append(f"{session_uuid}: {response.status} {payload}")
+                if payload.get("end") or payload.get("transfer"):
+                    break
+        connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, errors
+
+
+def main_():
+    parser = argparse.ArgumentParser(description="Load test /process_text_mp3")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--db-latency-ms", type=float, default=1.0,
+                        help="simulated MySQL round trip for the in-process stand-in")
+    parser.add_argument("--target", help="base URL of a running server instead of the in-process one")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON from an earlier --save to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    server = None
+    main = None
+    target = args.target
+    if not target:
+        main = import_main(db_latency=args.db_latency_ms / 1000, log_level=args.log_level)
+        instrument(main, timer)
+        server, target = start_server(main)
+
+    elapsed, errors = run_calls(target, args.calls, args.concurrency, args.seed, timer)
+
+    if server:
+        server.shutdown()
+        main.log_writer.stop()
+
+    turns = len(timer.samples.get("request", []))
+    print(f"{args.calls} calls, {turns} turns, concurrency {args.concurrency}, {elapsed:.2f}s")
+    print(f"throughput: {turns / elapsed:.1f} turns/s, {args.calls / elapsed:.1f} calls/s, {len(errors)} errors")
+    if main:
+        rows, batches = main.get_db_pool().written(main.LOG_INSERT_QUERY)
+        print(f"db stand-in: {rows} log rows in {batches} batches")
+    summary = timer.summary()
+    print_summary(summary)
+    for error in errors[:10]:
+        print(f"error: {error}")
+
+    results = {"turns_per_second": turns / elapsed, "errors": len(errors), "stages": summary}
+    if args.save:
+        save_results(args.save, results)
+    if args.baseline:
+        regressions = compare_with_baseline(summary, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,111 @@
+# Benchmark for map_user_input.
+#
+# Checks that the compiled IntentMatcher (the exact/substring fast path of
+# map_user_input, without the fuzzy fallback) returns the same intent as the
+# original nested phrase scan for every utterance in utterances.txt (plus
+# every mapped phrase and a few derived variants), then reports per-call
+# latency for both implementations.
+#
+# Run from the repository root:
+#     python benchmarks/bench_map_user_input.py [--repeat N]
+
+import argparse
+import os
+import sys
+import time
+
+from harness import ROOT, import_main
+
+main = import_main()
+campaign = main.campaign_store.get()
+
+
+# The original implementation, kept verbatim as the reference.
+def legacy_map_user_input(user_input_lower):
+    cleaned_input = user_input_lower.replace('_', ' ')
+    words = cleaned_input.split()
+    filtered_words = [word for word in words if word not in campaign.stop_words]
+
+    if not filtered_words:
+        return "something_else"
+
+    filtered_input = " ".join(filtered_words)
+
+    for key, phrases in campaign.intents.items():
+        for phrase in phrases:
+            if cleaned_input == phrase:
+                return key
+
+    for key, phrases in campaign.intents.items():
+        for phrase in phrases:
+            phrase_words = phrase.split()
+            filtered_phrase_words = [word for word in phrase_words if word not in campaign.stop_words]
+            filtered_phrase = " ".join(filtered_phrase_words)
+
+            if filtered_input == filtered_phrase:
+                return key
+
+            if filtered_phrase and filtered_phrase in filtered_input:
+                return key
+
+    return "something_else"
+
+
+def load_corpus():
+    path = os.path.join(ROOT, "benchmarks", "utterances.txt")
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            corpus.append(line.rstrip("\n").lower().strip())
+    return corpus
+
+
+def equivalence_corpus(corpus):
+    extra = ["", " ", "_", "__"]
+    for phrases in campaign.intents.values():
+        for phrase in phrases:
+            lowered = phrase.lower()
+            extra.extend([phrase, lowered, f"well {lowered} i guess", lowered.replace(" ", "_")])
+    return corpus + extra
+
+
+def time_per_call(func, corpus, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in corpus:
+            func(text)
+    elapsed = time.perf_counter() - start
+    return elapsed / (repeat * len(corpus))
+
+
+def main_():
+    parser = argparse.ArgumentParser(description="Benchmark map_user_input")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    mismatches = []
+    for text in equivalence_corpus(corpus):
+        expected = legacy_map_user_input(text)
+        actual = campaign.intent_matcher.match(text)
+        if expected != actual:
+            mismatches.append((text, expected, actual))
+
+    for text, expected, actual in mismatches:
+        print(f"MISMATCH {text!r}: legacy={expected} compiled={actual}")
+    if mismatches:
+        sys.exit(1)
+    print(f"identical results on {len(equivalence_corpus(corpus))} inputs")
+
+    unmatched = [text for text in corpus if legacy_map_user_input(text) == "something_else"]
+    for label, inputs in (("corpus", corpus), ("unmatched only", unmatched)):
+        legacy = time_per_call(legacy_map_user_input, inputs, args.repeat)
+        compiled = time_per_call(campaign.intent_matcher.match, inputs, args.repeat)
+        print(f"{label:15} legacy {legacy * 1e6:8.1f} us/call   "
+              f"compiled {compiled * 1e6:6.1f} us/call   x{legacy / compiled:.1f}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,96 @@
+# Microbenchmarks for the per-turn pipeline: map_user_input on the utterance
+# corpus, the fuzzy fallback on the utterances the exact matcher misses, and
+# process_user_input over the scripted conversations, each call with a fresh
+# uuid. Uses the MySQL stand-in, so no database is needed.
+#
+# Run from the repository root:
+#     python benchmarks/bench_pipeline.py [--repeat N] [--save FILE] [--baseline FILE]
+
+import argparse
+import os
+import sys
+import time
+
+from harness import (CONVERSATION_SCRIPTS, ROOT, compare_with_baseline, import_main, print_summary, save_results,
+                     summarize)
+
+
+def load_corpus():
+    with open(os.path.join(ROOT, "benchmarks", "utterances.txt"), encoding="utf-8") as f:
+        return [line.strip().lower() for line in f if line.strip() and not line.startswith("#")]
+
+
+def bench_map_user_input(main, corpus, repeat):
+    samples = []
+    clock = time.perf_counter
+    map_user_input = main.map_user_input
+    campaign = main.campaign_store.get()
+    for _ in range(repeat):
+        for text in corpus:
+            start = clock()
+            map_user_input(campaign, text)
+            samples.append(clock() - start)
+    return samples
+
+
+def bench_fuzzy_match(main, corpus, repeat):
+    samples = []
+    clock = time.perf_counter
+    campaign = main.campaign_store.get()
+    misses = [text for text in corpus if campaign.intent_matcher.match(text) == "something_else"]
+    match = campaign.fuzzy_matcher.match
+    for _ in range(repeat):
+        for text in misses:
+            start = clock()
+            match(text)
+            samples.append(clock() - start)
+    return samples
+
+
+def bench_process_user_input(main, repeat):
+    samples = []
+    clock = time.perf_counter
+    process_user_input = main.process_user_input
+    call_id = 0
+    for _ in range(repeat):
+        for script in CONVERSATION_SCRIPTS:
+            call_id += 1
+            session_uuid = f"micro-{call_id}"
+            for text in script:
+                start = clock()
+                process_user_input(text, session_uuid, "5550000000")
+                samples.append(clock() - start)
+            main.conversation_states.discard(session_uuid)
+    return samples
+
+
+def main_():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for map_user_input and process_user_input")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--save", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON from an earlier --save to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    main = import_main(log_level="WARNING")
+    corpus = load_corpus()
+    summary = {
+        "map_user_input": summarize(bench_map_user_input(main, corpus, args.repeat)),
+        "process_user_input": summarize(bench_process_user_input(main, args.repeat)),
+    }
+    if main.campaign_store.get().fuzzy_matcher is not None:
+        summary["fuzzy_match"] = summarize(bench_fuzzy_match(main, corpus, args.repeat))
+    print_summary(summary)
+
+    if args.save:
+        save_results(args.save, {"stages": summary})
+    if args.baseline:
+        regressions = compare_with_baseline(summary, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,211 @@
+# Shared setup for the benchmarks.
+#
+# import_main() loads main.py against an in-process stand-in for the MySQL
+# pool, so the app can be exercised without a database server. The stand-in
+# accepts every query, counts the rows written by each INSERT statement and
+# can add a fixed delay per round trip to mimic a real server.
+
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Multi-turn scripts used by the load test and the process_user_input
+# microbenchmark, roughly in the proportions seen on live campaigns.
+CONVERSATION_SCRIPTS = [
+    ["hello", "yes"],
+    ["hi", "yeah i do", "federal"],
+    ["hello", "no", "no"],
+    ["who is this", "what is this about", "yes"],
+    ["hello", "i'm not sure", "yes"],
+    ["what", "huh", "i don't know", "yes"],
+    ["hello", "stop calling me"],
+    ["are you a robot", "no"],
+    ["hello", "silence", "silence"],
+    ["this is a business line", "no", "maybe", "yes"],
+]
+
+
+class StandInCursor:
+    def __init__(self, connection, dictionary=False):
+        self.connection = connection
+        self.dictionary = dictionary
+        self.rowcount = 0
+        self._rows = []
+
+    def _round_trip(self):
+        if self.connection.pool.latency:
+            time.sleep(self.connection.pool.latency)
+
+    def execute(self, query, params=None):
+        self._round_trip()
+        self._rows = []
+        self.rowcount = 0
+        if query.lstrip().upper().startswith("INSERT"):
+            self.connection.pool.record(query, [params])
+            self.rowcount = 1
+
+    def executemany(self, query, seq_params):
+        self._round_trip()
+        rows = list(seq_params)
+        self.connection.pool.record(query, rows)
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    unread_result = False
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, dictionary=False, **kwargs):
+        return StandInCursor(self, dictionary)
+
+    def commit(self):
+        if self.pool.latency:
+            time.sleep(self.pool.latency)
+
+    def rollback(self):
+        pass
+
+    def consume_results(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class StandInPool:
+    latency = 0.0
+
+    def __init__(self, **config):
+        self.config = config
+        # statement -> [rows, batches]
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def record(self, query, rows):
+        with self._lock:
+            counts = self.statements.setdefault(query, [0, 0])
+            counts[0] += len(rows)
+            counts[1] += 1
+
+    # (rows, batches) written by one statement
+    def written(self, query):
+        rows, batches = self.statements.get(query, (0, 0))
+        return rows, batches
+
+    def get_connection(self):
+        return StandInConnection(self)
+
+
+def import_main(db_latency=0.0, log_level="WARNING", env=None):
+    os.chdir(ROOT)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    settings = {
+        "MYSQL_HOST": "127.0.0.1", "MYSQL_USER": "bench", "MYSQL_PASSWORD": "bench",
+        "MYSQL_DATABASE": "bench", "MYSQL_PORT": "3306", "LOG_LEVEL": log_level,
+    }
+    settings.update(env or {})
+    for name, value in settings.items():
+        os.environ[name] = value
+
+    from mysql.connector import pooling
+    StandInPool.latency = db_latency
+    pooling.MySQLConnectionPool = StandInPool
+
+    import main
+    return main
+
+
+# Collects durations per stage; list.append is atomic, so worker threads can
+# record without a lock.
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, func):
+        samples = self.samples.setdefault(stage, [])
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+
+        return timed
+
+    def summary(self):
+        return {stage: summarize(samples) for stage, samples in self.samples.items() if samples}
+
+
+def percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(pct / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+# Summary in milliseconds
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+    }
+
+
+def print_summary(summary):
+    print(f"{'stage':28} {'count':>8} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, stats in summary.items():
+        print(f"{stage:28} {stats['count']:8d} {stats['mean_ms']:9.3f} {stats['p50_ms']:9.3f} "
+              f"{stats['p95_ms']:9.3f} {stats['p99_ms']:9.3f}")
+
+
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+# Compare p95 per stage against a saved run. Returns the regressions found.
+def compare_with_baseline(summary, baseline_path, max_regression):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["stages"]
+    regressions = []
+    for stage, stats in summary.items():
+        before = baseline.get(stage)
+        if not before or not before["p95_ms"]:
+            continue
+        change = stats["p95_ms"] / before["p95_ms"] - 1
+        if change > max_regression:
+            regressions.append(f"{stage}: p95 {before['p95_ms']:.3f} ms -> {stats['p95_ms']:.3f} ms (+{change:.0%})")
+    return regressions
@@ -0,0 +1,346 @@
+# Campaign scripts: the prompts, intents, audio and call flow of a campaign,
+# read from <directory>/<name>.json.
+#
+# Each file is compiled once into a Campaign holding its IntentMatcher,
+# FuzzyMatcher, ConversationFlow and a TurnResponse for every (prompt, end,
+# transfer) and audio format, so a turn only looks things up. Campaigns are never changed once
+# built. CampaignStore polls the directory and recompiles a file when it
+# changes; the new version goes live by swapping one dict reference, so a
+# request sees either the old set of campaigns or the new one, never a mix. A
+# file that fails to compile is logged and the version already loaded stays
+# in service.
+#
+# A call is pinned to the version it started on (CallState.campaign).
+# Superseded versions are kept for retain seconds, the session TTL, so calls
+# in flight during a reload finish on the script they started with.
+#
+# File sections ("fuzzy_phrases", "stop_words" and "audio" are optional):
+#   prompts        prompt key -> text
+#   intents        intent -> phrases, in match priority order; must include
+#                  "something_else", the intent of unmatched input
+#   fuzzy_phrases  intent -> canonical phrases for the fuzzy fallback; list
+#                  multi-word answers only, short words carry too few n-grams
+#                  to match on reliably
+#   stop_words     words the phrase matcher ignores
+#   dnc_phrases    what a caller must say to go on the do-not-call list, on
+#                  top of matching a DNC intent; default: the multi-word
+#                  phrases of the DNC intents
+#   audio          prompt key -> recording in the audio directory, default
+#                  <key>.mp3; prompts with the same text share a recording
+#   flow           the call flow, see conversation_flow.py
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import Response
+
+import metrics
+from audio_variants import ORIGINAL, variant_filename
+from conversation_flow import ConversationFlow
+from fuzzy_matcher import FuzzyMatcher
+from intent_matcher import IntentMatcher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTENT = "something_else"
+
+# Intents that ask for the caller's number to go on the do-not-call list
+DNC_INTENTS = ("do_not_call", "not_a_problem")
+
+_WORDS = re.compile(r"[\w']+")
+
+
+# Input as its words, lower case and apostrophes unified
+def dnc_words(text):
+    return " ".join(_WORDS.findall(text.lower().replace("\u2019", "'")))
+
+
+class CampaignError(ValueError):
+    pass
+
+
+# Everything a turn can answer with, rendered once. Only the prompt, the
+# end/transfer flags and the audio format vary between turns, so the JSON body
+# is serialized here instead of on every request. variants holds the same
+# answer pointing at each telephony rendition of the audio.
+class TurnResponse:
+    __slots__ = ("prompt_key", "text", "end", "transfer", "audio_url", "payload", "json", "body", "status",
+                 "variants")
+
+    def __init__(self, prompt_key, text, end, transfer, audio_url):
+        self.prompt_key = prompt_key
+        self.text = text
+        self.end = end
+        self.transfer = transfer
+        self.audio_url = audio_url
+        payload = {'response': text, 'end': end, 'transfer': transfer}
+        if audio_url is None:
+            payload['error'] = 'Failed to generate audio response'
+            self.status = 500
+        else:
+            payload['audio_url'] = audio_url
+            self.status = 200
+        self.payload = payload
+        self.json = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+        self.body = self.json + b"\n"
+        self.variants = {}
+
+    # The same answer with audio in the given format; the MP3 one when that
+    # format has no rendition
+    def in_format(self, audio_format):
+        return self.variants.get(audio_format, self)
+
+    def to_response(self):
+        return Response(self.body, status=self.status, mimetype='application/json')
+
+
+# Prompt text -> audio file, for prompts whose recording is loaded.
+# Recordings whose name differs only in case are found too.
+def resolve_audio_files(prompts, audio, audio_cache):
+    by_lower_name = {filename.lower(): filename for filename in audio_cache.files}
+    files = {}
+    for key, text in prompts.items():
+        if text in files:
+            continue
+        filename = audio.get(key, f"{key}.mp3")
+        if filename not in audio_cache:
+            filename = by_lower_name.get(filename.lower())
+        if filename is not None:
+            files[text] = filename
+    return files
+
+
+class Campaign:
+    def __init__(self, name, version, definition, audio_cache, audio_base_url, fuzzy_threshold=None,
+                 audio_variants=None):
+        self.name = name
+        self.version = version
+        self.key = f"{name}@{version}"
+        self.description = definition.get("description", "")
+        self.prompts = dict(definition["prompts"])
+        self.intents = {intent: list(phrases) for intent, phrases in definition["intents"].items()}
+        if DEFAULT_INTENT not in self.intents:
+            raise CampaignError(f"Campaign '{name}' has no '{DEFAULT_INTENT}' intent")
+        self.stop_words = frozenset(definition.get("stop_words", ()))
+
+        # Phrase lists compiled once into an exact-match table plus substring
+        # automaton; the fuzzy matcher only scores what that misses
+        self.intent_matcher = IntentMatcher(self.intents, self.stop_words, default=DEFAULT_INTENT)
+        self.fuzzy_matcher = None
+        fuzzy_phrases = definition.get("fuzzy_phrases")
+        if fuzzy_phrases and fuzzy_threshold is not None:
+            for intent in fuzzy_phrases:
+                if intent not in self.intents:
+                    raise CampaignError(f"Unknown intent '{intent}' in fuzzy_phrases")
+            self.fuzzy_matcher = FuzzyMatcher(fuzzy_phrases, threshold=fuzzy_threshold)
+
+        self.flow = ConversationFlow(definition["flow"], self.prompts, self.intents)
+
+        # The intent matchers accept loose substring and fuzzy matches ("put",
+        # "call"), too weak to list a number on. A number is listed only when
+        # the input is one of these phrases or contains one of more than one
+        # word.
+        dnc_phrases = definition.get("dnc_phrases")
+        if dnc_phrases is None:
+            dnc_phrases = [phrase for intent in DNC_INTENTS for phrase in self.intents.get(intent, ())
+                           if len(dnc_words(phrase).split()) > 1]
+        self.dnc_phrases = tuple(words for words in map(dnc_words, dnc_phrases) if words)
+
+        audio = definition.get("audio", {})
+        for prompt_key in audio:
+            if prompt_key not in self.prompts:
+                raise CampaignError(f"Unknown prompt '{prompt_key}' in audio")
+        self.audio_base_url = audio_base_url
+        self.audio_variants = audio_variants
+        self.audio_files = resolve_audio_files(self.prompts, audio, audio_cache)
+        self.responses = {}
+        for prompt_key, text in self.prompts.items():
+            for end in (0, 1):
+                for transfer in (0, 1):
+                    turn = TurnResponse(prompt_key, text, end, transfer, self.audio_url(text))
+                    for audio_format in (audio_variants.formats if audio_variants else ()):
+                        turn.variants[audio_format] = TurnResponse(
+                            prompt_key, text, end, transfer, self.audio_url(text, audio_format))
+                    self.responses[(prompt_key, end, transfer)] = turn
+        # Answer to input that never reaches the flow
+        self.invalid_input = self.responses[(self.flow.fallback.prompt, 0, 0)]
+        # Answer to the first turn of a call to a number on the do-not-call list
+        self.dnc_blocked = self.responses[(self.flow.repeat_end.prompt, 1, 0)]
+
+    # URL of the recording of text in audio_format, falling back to the MP3
+    # when the format has no rendition of it
+    def audio_url(self, text, audio_format=ORIGINAL):
+        filename = self.audio_files.get(text)
+        if filename is None:
+            return None
+        if audio_format != ORIGINAL and self.audio_variants.get(audio_format, filename) is not None:
+            return f"{self.audio_base_url}{audio_format}/{variant_filename(filename)}"
+        return f"{self.audio_base_url}{filename}"
+
+    # True when the input plainly asks not to be called again
+    def is_dnc_request(self, text):
+        words = dnc_words(text)
+        padded = f" {words} "
+        return any(words == phrase or (" " in phrase and f" {phrase} " in padded) for phrase in self.dnc_phrases)
+
+    def describe(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "description": self.description,
+            "prompts": len(self.prompts),
+            "intents": len(self.intents),
+            "steps": len(self.flow.steps),
+            "fuzzy": self.fuzzy_matcher is not None,
+        }
+
+
+class CampaignStore:
+    def __init__(self, directory, audio_cache, audio_base_url, default="default", fuzzy_threshold=None,
+                 reload_interval=5.0, retain=900.0, audio_variants=None, clock=time.monotonic):
+        self.directory = directory
+        self.audio_cache = audio_cache
+        self.audio_base_url = audio_base_url
+        self.audio_variants = audio_variants
+        self.default = default
+        self.fuzzy_threshold = fuzzy_threshold
+        self.reload_interval = reload_interval
+        self.retain = retain
+        self.clock = clock
+        # Both dicts are replaced, never mutated, on reload
+        self.campaigns = {}
+        self._versions = {}
+        self._files = {}
+        self._superseded = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __contains__(self, name):
+        return name in self.campaigns
+
+    # Current version of a campaign, the default one if name is None
+    def get(self, name=None):
+        return self.campaigns.get(name or self.default)
+
+    # The campaign a call runs on. A new call starts on the current version
+    # of the named campaign; later turns stay on that version whatever they
+    # name. Raises KeyError for an unknown campaign.
+    def for_call(self, state, name=None):
+        key = state.campaign
+        if key is not None:
+            campaign = self._versions.get(key) or self._pinned_elsewhere(key)
+            if campaign is not None:
+                return campaign
+            name = key.rsplit("@", 1)[0]
+            logger.warning(f"Campaign version {key} is no longer loaded, moving the call to the current version")
+        campaign = self.get(name)
+        if campaign is None:
+            raise KeyError(f"Unknown campaign '{name}'")
+        if key is None:
+            state.step = campaign.flow.initial_step
+            state.last_prompt = campaign.flow.initial_prompt
+        state.campaign = campaign.key
+        return campaign
+
+    # With a shared session store, a call may have started in a worker that
+    # picked up a new version before this one did
+    def _pinned_elsewhere(self, key):
+        self.reload()
+        return self._versions.get(key)
+
+    def start(self):
+        self.reload()
+        if self.default not in self.campaigns:
+            raise CampaignError(f"Default campaign '{self.default}' not found in {self.directory}")
+        if self.reload_interval > 0:
+            self._thread = threading.Thread(target=self._reload_periodically, name="campaign-reload", daemon=True)
+            self._thread.start()
+        return self
+
+    def _reload_periodically(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"Error reloading campaigns: {e}")
+
+    # Recompile the files that changed since the last reload, or every file
+    # with force (once the audio renditions they point at are built); returns
+    # the names of the campaigns that went live
+    def reload(self, force=False):
+        with self._lock:
+            try:
+                filenames = sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+            except OSError as e:
+                logger.error(f"Error listing campaigns in {self.directory}: {e}")
+                return []
+
+            now = self.clock()
+            campaigns = dict(self.campaigns)
+            versions = dict(self._versions)
+            files = {}
+            loaded = []
+            for filename in filenames:
+                name = filename[:-len(".json")]
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if not force and self._files.get(name) == signature:
+                    files[name] = signature
+                    continue
+                files[name] = signature
+
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    version = hashlib.sha256(data).hexdigest()[:12]
+                    current = campaigns.get(name)
+                    if not force and current is not None and current.version == version:
+                        continue
+                    campaign = (not force and versions.get(f"{name}@{version}")) or Campaign(
+                        name, version, json.loads(data), self.audio_cache, self.audio_base_url,
+                        fuzzy_threshold=self.fuzzy_threshold, audio_variants=self.audio_variants)
+                except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                    logger.error(f"Campaign '{name}' in {path} failed to compile, keeping the loaded version: {e}")
+                    metrics.CAMPAIGN_RELOADS.labels("error").inc()
+                    continue
+
+                if current is not None and current.key != campaign.key:
+                    self._superseded[current.key] = now
+                self._superseded.pop(campaign.key, None)
+                campaigns[name] = versions[campaign.key] = campaign
+                loaded.append(name)
+                metrics.CAMPAIGN_RELOADS.labels("loaded").inc()
+                logger.info(f"Campaign '{name}' version {version} is live")
+
+            # A deleted file starts no new calls; its calls in flight finish
+            for name in set(campaigns) - set(files):
+                self._superseded[campaigns.pop(name).key] = now
+                logger.info(f"Campaign '{name}' removed")
+            for key, since in list(self._superseded.items()):
+                if now - since > self.retain:
+                    versions.pop(key, None)
+                    del self._superseded[key]
+
+            self._files = files
+            self._versions = versions
+            self.campaigns = campaigns
+            return loaded
+
+    def stats(self):
+        campaigns = self.campaigns
+        return {
+            "default": self.default,
+            "campaigns": [campaign.describe() for _, campaign in sorted(campaigns.items())],
+            "retained_versions": sorted(key for key in self._versions
+                                        if key not in {campaign.key for campaign in campaigns.values()}),
+        }
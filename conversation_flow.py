@@ -0,0 +1,158 @@
+# Table-driven conversation engine.
+#
+# The call flow is declared as data (see the "flow" section of
+# campaigns/default.json) and compiled once into a dict keyed by (step, intent), so a turn costs one
+# lookup whatever the size of the flow. Intents listed under "global" answer
+# the same way in every step; each step maps intents to transitions and "*"
+# covers everything else. A transition may set "next" (the step to move to),
+# "prompt", "end" and "transfer"; ending a call resets its state. A call opens
+# on "initial_prompt", by default the prompt named after the initial step.
+#
+# The definition is validated while compiling: unknown prompts, intents or
+# steps, steps without a "*" rule, steps that can never be reached from the
+# initial step and steps from which the call can never end or transfer are
+# all rejected with FlowError.
+
+
+class FlowError(ValueError):
+    pass
+
+
+class Transition:
+    __slots__ = ("next_step", "prompt", "end", "transfer", "reason", "key")
+
+    def __init__(self, next_step, prompt, end=0, transfer=0, reason=None):
+        self.next_step = next_step
+        self.prompt = prompt
+        self.end = end
+        self.transfer = transfer
+        self.reason = reason
+        self.key = (prompt, end, transfer)
+
+
+class ConversationFlow:
+    def __init__(self, definition, prompts, intents):
+        self.prompts = prompts
+        self.intents = list(intents)
+        self.intent_index = {intent: index for index, intent in enumerate(self.intents)}
+        self.initial_step = definition["initial_step"]
+        self.repeat_limit = definition.get("repeat_limit", 2)
+        self.repeat_exempt = frozenset(definition.get("repeat_exempt", ()))
+        self.silence_inputs = frozenset(definition.get("silence_inputs", ()))
+        self.silence_limit = definition.get("silence_limit", 2)
+
+        end_prompt = definition["end_prompt"]
+        self._check_prompt(end_prompt, "end_prompt")
+        self._check_prompt(definition["fallback_prompt"], "fallback_prompt")
+        self.initial_prompt = definition.get(
+            "initial_prompt", self.initial_step if self.initial_step in prompts else definition["fallback_prompt"])
+        self._check_prompt(self.initial_prompt, "initial_prompt")
+        self.repeat_end = Transition(None, end_prompt, 1, 0, "repeated_input")
+        self.silence_end = Transition(None, end_prompt, 1, 0, "silence")
+        self.fallback = Transition(None, definition["fallback_prompt"])
+        # Silence replays whatever was said last, without moving the call on
+        self.replays = {prompt: Transition(None, prompt) for prompt in prompts}
+
+        self.steps = definition["steps"]
+        if self.initial_step not in self.steps:
+            raise FlowError(f"Initial step '{self.initial_step}' is not defined")
+        self.dispatch = self._compile(definition.get("global", {}), self.steps)
+        self._validate()
+
+    def _check_prompt(self, prompt, where):
+        if prompt not in self.prompts:
+            raise FlowError(f"Unknown prompt '{prompt}' in {where}")
+
+    def _transition(self, rule, where):
+        next_step = rule.get("next")
+        if next_step is not None and next_step not in self.steps:
+            raise FlowError(f"Unknown step '{next_step}' in {where}")
+        prompt = rule["prompt"]
+        self._check_prompt(prompt, where)
+        return Transition(next_step, prompt, int(rule.get("end", 0)), int(rule.get("transfer", 0)))
+
+    def _compile(self, global_rules, steps):
+        for intent in global_rules:
+            if intent not in self.intent_index:
+                raise FlowError(f"Unknown intent '{intent}' in global rules")
+        global_transitions = {
+            intent: self._transition(rule, f"global rule '{intent}'")
+            for intent, rule in global_rules.items()
+        }
+
+        dispatch = {}
+        for step, rules in steps.items():
+            if "*" not in rules:
+                raise FlowError(f"Step '{step}' has no '*' rule")
+            for intent in rules:
+                if intent != "*" and intent not in self.intent_index:
+                    raise FlowError(f"Unknown intent '{intent}' in step '{step}'")
+            default = self._transition(rules["*"], f"step '{step}' rule '*'")
+            for intent in self.intents:
+                if intent in global_transitions:
+                    dispatch[(step, intent)] = global_transitions[intent]
+                elif intent in rules:
+                    dispatch[(step, intent)] = self._transition(rules[intent], f"step '{step}' rule '{intent}'")
+                else:
+                    dispatch[(step, intent)] = default
+        return dispatch
+
+    def _successors(self, step):
+        successors = set()
+        for intent in self.intents:
+            transition = self.dispatch[(step, intent)]
+            if transition.end:
+                successors.add(self.initial_step)
+            else:
+                successors.add(transition.next_step or step)
+        return successors
+
+    def _validate(self):
+        reachable = {self.initial_step}
+        pending = [self.initial_step]
+        while pending:
+            for successor in self._successors(pending.pop()):
+                if successor not in reachable:
+                    reachable.add(successor)
+                    pending.append(successor)
+        unreachable = sorted(set(self.steps) - reachable)
+        if unreachable:
+            raise FlowError(f"Unreachable steps: {', '.join(unreachable)}")
+
+        # A step is live if some path from it ends or transfers the call
+        live = {
+            step for step in self.steps
+            if any(self.dispatch[(step, intent)].end or self.dispatch[(step, intent)].transfer
+                   for intent in self.intents)
+        }
+        changed = True
+        while changed:
+            changed = False
+            for step in self.steps:
+                if step not in live and self._successors(step) & live:
+                    live.add(step)
+                    changed = True
+        dead = sorted(set(self.steps) - live)
+        if dead:
+            raise FlowError(f"Steps that can never end or transfer the call: {', '.join(dead)}")
+
+    # Apply one turn to state and return the Transition taken. The caller
+    # resets the call when transition.end is set.
+    def advance(self, state, mapped_input, user_input_lower):
+        # End call if any input (except the exempt ones) is repeated
+        input_count = state.count_input(self.intent_index[mapped_input])
+        if mapped_input not in self.repeat_exempt and input_count >= self.repeat_limit:
+            return self.repeat_end
+        state.last_input = mapped_input
+
+        if user_input_lower in self.silence_inputs:
+            state.repeat_count += 1
+            if state.repeat_count >= self.silence_limit:
+                return self.silence_end
+            return self.replays.get(state.last_prompt, self.fallback)
+
+        transition = self.dispatch.get((state.step, mapped_input), self.fallback)
+        if transition.next_step is not None:
+            state.step = transition.next_step
+        state.last_prompt = transition.prompt
+        return transition
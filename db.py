@@ -0,0 +1,21 @@
+# Helpers for connections borrowed from the MySQL pool.
+
+from mysql.connector import Error
+
+
+# Give a connection back to the pool once a query is done with it, whatever
+# happened. A pooled connection must go back even if it died mid-query: the
+# pool reconnects it on the next get_connection(), whereas one that is never
+# returned is a pool slot lost until the process restarts. Cleanup errors on
+# a dead connection are ignored so they cannot skip the close.
+def release_connection(connection, cursor=None):
+    if connection is None:
+        return
+    try:
+        if connection.unread_result:
+            connection.consume_results()
+        if cursor is not None:
+            cursor.close()
+    except Error:
+        pass
+    connection.close()
@@ -0,0 +1,230 @@
+# Do-not-call registry.
+#
+# Numbers are normalised to their digits (NANP numbers to the 10-digit form)
+# and kept as a sorted numpy int64 array, 8 bytes per number, so a check is a
+# binary search over contiguous memory. Numbers added since the array was
+# built sit in a small set next to it. A local snapshot of the array is
+# memory-mapped at startup, so even a list of millions of numbers costs no
+# startup time and no DB round trip. A background thread pulls the rows added
+# to the MySQL dnc table since the last id it saw, merges them in and
+# rewrites the snapshot. Numbers are never removed.
+#
+# Bulk import of an external list (one number per line, or CSV with the
+# number in the first column):
+#     python dnc_registry.py import numbers.csv --source federal_dnc
+
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from mysql.connector import Error
+
+from db import release_connection
+
+logger = logging.getLogger(__name__)
+
+_NON_DIGITS = re.compile(r"\D+")
+
+INSERT_QUERY = "INSERT IGNORE INTO dnc (number, source) VALUES (%s, %s)"
+
+
+# Returns the number as an int, or None if it cannot be a phone number
+def normalize_number(number):
+    if number is None:
+        return None
+    digits = _NON_DIGITS.sub("", str(number))
+    if len(digits) == 11 and digits[0] == "1":
+        digits = digits[1:]
+    if not 7 <= len(digits) <= 15:
+        return None
+    return int(digits)
+
+
+class DncRegistry:
+    def __init__(self, get_connection, snapshot_path, refresh_interval=60.0, fetch_size=50000,
+                 merge_threshold=10000):
+        self.get_connection = get_connection
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.fetch_size = fetch_size
+        self.merge_threshold = merge_threshold
+        self.numbers = np.empty(0, dtype=np.int64)
+        self.recent = set()
+        self.last_id = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __contains__(self, number):
+        key = normalize_number(number)
+        if key is None:
+            return False
+        if key in self.recent:
+            return True
+        numbers = self.numbers
+        index = int(np.searchsorted(numbers, key))
+        return index < len(numbers) and int(numbers[index]) == key
+
+    def __len__(self):
+        return len(self.numbers) + len(self.recent)
+
+    # Takes effect in this process at once; the row reaches MySQL with the
+    # call's log rows
+    def add(self, number):
+        key = normalize_number(number)
+        if key is None:
+            return False
+        with self._lock:
+            self.recent.add(key)
+        return True
+
+    def start(self):
+        self.load_snapshot()
+        self._thread = threading.Thread(target=self._refresh_periodically, name="dnc-refresh", daemon=True)
+        self._thread.start()
+        return self
+
+    def load_snapshot(self):
+        try:
+            numbers = np.load(self.snapshot_path, mmap_mode="r")
+            with open(f"{self.snapshot_path}.json") as f:
+                last_id = json.load(f)["last_id"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f"No do-not-call snapshot loaded from {self.snapshot_path}: {e}")
+            return
+        self.numbers = numbers
+        self.last_id = last_id
+        logger.info(f"Loaded {len(numbers)} do-not-call numbers from {self.snapshot_path}")
+
+    # refresh() handles MySQL errors itself; anything else is logged here so
+    # it cannot end the thread and freeze the registry
+    def _refresh_periodically(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Error refreshing do-not-call registry")
+            time.sleep(self.refresh_interval)
+
+    # Pull rows added to MySQL since the last refresh
+    def refresh(self):
+        connection = self.get_connection()
+        if not connection:
+            return
+        cursor = None
+        chunks = []
+        last_id = self.last_id
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT id, number FROM dnc WHERE id > %s ORDER BY id", (last_id,))
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                chunk = np.array(rows, dtype=np.int64)
+                chunks.append(chunk[:, 1])
+                last_id = int(chunk[-1, 0])
+        except Error as e:
+            logger.error(f"Error refreshing do-not-call registry: {e}")
+            return
+        finally:
+            release_connection(connection, cursor)
+
+        if not chunks:
+            return
+        added = np.concatenate(chunks)
+        if len(added) + len(self.recent) < self.merge_threshold:
+            with self._lock:
+                self.recent.update(int(number) for number in added)
+            self.last_id = last_id
+        else:
+            self._merge(added, last_id)
+        logger.info(f"Do-not-call registry refreshed with {len(added)} numbers, {len(self)} in total")
+
+    # Fold the new numbers and the recent set into the sorted array
+    def _merge(self, added, last_id):
+        with self._lock:
+            pending = list(self.recent)
+        merged = np.union1d(np.union1d(self.numbers, added), np.array(pending, dtype=np.int64))
+        with self._lock:
+            self.numbers = merged
+            self.recent = self.recent.difference(pending)
+        self.last_id = last_id
+        self.write_snapshot(merged, last_id)
+
+    # Every worker merges on its own schedule; per-process temporary names
+    # keep two of them from writing into the same file
+    def write_snapshot(self, numbers, last_id):
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        tmp_meta_path = f"{self.snapshot_path}.json.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, numbers)
+            with open(tmp_meta_path, "w") as f:
+                json.dump({"last_id": last_id, "count": len(numbers)}, f)
+            # The array first: a newer array with an older last_id only
+            # re-reads a few rows on the next start
+            os.replace(tmp_path, self.snapshot_path)
+            os.replace(tmp_meta_path, f"{self.snapshot_path}.json")
+        except OSError as e:
+            logger.error(f"Error writing do-not-call snapshot: {e}")
+            for path in (tmp_path, tmp_meta_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def read_numbers(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            key = normalize_number(line.split(",", 1)[0])
+            if key is not None:
+                yield key
+
+
+# Insert every number in path; returns (valid numbers, new rows)
+def import_numbers(connection, path, source, batch_size=10000):
+    numbers = np.unique(np.fromiter(read_numbers(path), dtype=np.int64))
+    inserted = 0
+    cursor = connection.cursor()
+    try:
+        for start in range(0, len(numbers), batch_size):
+            cursor.executemany(INSERT_QUERY, [(int(number), source)
+                                              for number in numbers[start:start + batch_size]])
+            inserted += cursor.rowcount
+            connection.commit()
+    finally:
+        cursor.close()
+    return len(numbers), inserted
+
+
+if __name__ == "__main__":
+    import mysql.connector
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Manage the do-not-call registry")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_command = commands.add_parser("import", help="bulk import numbers from a file")
+    import_command.add_argument("path")
+    import_command.add_argument("--source", default="import")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    connection = mysql.connector.connect(
+        host=os.getenv("MYSQL_HOST"),
+        user=os.getenv("MYSQL_USER"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        database=os.getenv("MYSQL_DATABASE"),
+        port=int(os.getenv("MYSQL_PORT") or 3306),
+    )
+    try:
+        total, inserted = import_numbers(connection, args.path, args.source)
+        logger.info(f"Imported {inserted} new do-not-call numbers ({total} valid numbers in {args.path})")
+    finally:
+        connection.close()
@@ -0,0 +1,79 @@
+# Fuzzy fallback for utterances the exact/substring matcher misses.
+#
+# ASR output drifts in spelling ("i'm not sher", "nuh kloo"), and every
+# variant the phrase lists don't enumerate used to fall through to
+# "something_else". Here a compact set of canonical phrases per intent is
+# turned into L2-normalised character n-gram count vectors, stacked into one
+# matrix. An utterance is vectorised the same way and scored against every
+# phrase with a single matrix-vector product; the best phrase's intent wins
+# if its cosine similarity reaches the threshold.
+
+import re
+
+import numpy as np
+
+_NON_WORD = re.compile(r"[^a-z0-9 ]+")
+_APOSTROPHES = re.compile(r"['’‘`]")
+
+
+def normalize(text):
+    text = _APOSTROPHES.sub("", text.lower())
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def ngrams(text, sizes):
+    padded = f" {text} "
+    grams = []
+    for n in sizes:
+        grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return grams
+
+
+class FuzzyMatcher:
+    def __init__(self, phrases_by_intent, threshold=0.75, sizes=(2, 3), min_length=4):
+        self.threshold = threshold
+        self.sizes = sizes
+        self.min_length = min_length
+        self.vocabulary = {}
+        self.row_intents = []
+
+        rows = []
+        for intent, phrases in phrases_by_intent.items():
+            for phrase in phrases:
+                grams = ngrams(normalize(phrase), sizes)
+                if not grams:
+                    continue
+                rows.append([self.vocabulary.setdefault(gram, len(self.vocabulary)) for gram in grams])
+                self.row_intents.append(intent)
+
+        matrix = np.zeros((len(rows), len(self.vocabulary)), dtype=np.float32)
+        for row, indices in enumerate(rows):
+            np.add.at(matrix[row], indices, 1.0)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix / np.maximum(norms, 1e-9)
+
+    def _vector(self, text):
+        vocabulary = self.vocabulary
+        grams = ngrams(text, self.sizes)
+        indices = [vocabulary[gram] for gram in grams if gram in vocabulary]
+        if not indices:
+            return None
+        vector = np.bincount(indices, minlength=len(vocabulary)).astype(np.float32)
+        # Unknown n-grams still count towards the norm, so unrelated text
+        # that shares a few n-grams with a phrase scores low
+        return vector / np.sqrt(float(np.dot(vector, vector)) + (len(grams) - len(indices)))
+
+    # Returns (intent, score), or (None, score) below the threshold
+    def match(self, user_input_lower):
+        text = normalize(user_input_lower)
+        if len(text) < self.min_length or not self.row_intents:
+            return None, 0.0
+        vector = self._vector(text)
+        if vector is None:
+            return None, 0.0
+        scores = self.matrix @ vector
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        if score < self.threshold:
+            return None, score
+        return self.row_intents[best], score
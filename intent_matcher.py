@@ -0,0 +1,105 @@
+# Compiled matcher for the intent phrase lists of a campaign.
+#
+# The original map_user_input walked every phrase twice per call and
+# re-normalised each phrase on the second pass. The phrase lists are fixed
+# once a campaign is compiled, so everything is compiled up front into:
+#   - an exact-match table (phrase -> first key in dict order), and
+#   - an Aho-Corasick automaton over the normalised phrases, where every
+#     phrase carries its position in dict/list order as a rank.
+# A scan reports the lowest-ranked phrase contained in the input, which is
+# the same phrase the old nested loops would have stopped at.
+
+INF_RANK = float("inf")
+
+
+class IntentMatcher:
+    def __init__(self, mappings, stop_words=(), default="something_else"):
+        self.default = default
+        self.stop_words = frozenset(stop_words)
+        self.exact = {}
+        self.rank_keys = []
+
+        patterns = []
+        for key, phrases in mappings.items():
+            for phrase in phrases:
+                rank = len(self.rank_keys)
+                self.rank_keys.append(key)
+                self.exact.setdefault(phrase, key)
+                filtered_phrase = self._filter(phrase)
+                if filtered_phrase:
+                    patterns.append((filtered_phrase, rank))
+
+        self._build_automaton(patterns)
+
+    def _filter(self, text):
+        return " ".join(word for word in text.split() if word not in self.stop_words)
+
+    def _build_automaton(self, patterns):
+        goto = [{}]
+        best = [INF_RANK]
+        for pattern, rank in patterns:
+            node = 0
+            for ch in pattern:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    best.append(INF_RANK)
+                node = nxt
+            if rank < best[node]:
+                best[node] = rank
+
+        # Breadth-first pass to fill in failure links. Each node's best rank
+        # is folded with its failure node's, so a scan only has to look at
+        # the node it is currently on.
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for ch, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                target = goto[state].get(ch, 0)
+                fail[child] = target if target != child else 0
+                if best[fail[child]] < best[child]:
+                    best[child] = best[fail[child]]
+
+        self._goto = goto
+        self._fail = fail
+        self._best = best
+
+    def _scan(self, text):
+        goto = self._goto
+        fail = self._fail
+        best = self._best
+        node = 0
+        found = INF_RANK
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if best[node] < found:
+                found = best[node]
+                if found == 0:
+                    break
+        return found
+
+    def match(self, user_input_lower):
+        cleaned_input = user_input_lower.replace('_', ' ')
+        filtered_input = self._filter(cleaned_input)
+        if not filtered_input:
+            return self.default
+
+        key = self.exact.get(cleaned_input)
+        if key is not None:
+            return key
+
+        rank = self._scan(filtered_input)
+        if rank == INF_RANK:
+            return self.default
+        return self.rank_keys[rank]
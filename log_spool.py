@@ -0,0 +1,198 @@
+# Local append-only spool for log rows that could not reach MySQL.
+#
+# Rows are appended to segment files as length-prefixed records: a 4-byte
+# length and a 4-byte CRC32, both big-endian, then the row as JSON. A whole
+# batch is written and fsynced once, so a MySQL outage costs one fsync per
+# batch rather than one per row. Each process appends to its own segment,
+# named after its pid, and holds an exclusive flock on it while it is active.
+#
+# replay() hands closed segments back to MySQL in batches, oldest first,
+# through the insert_rows callable (which returns False on failure). The byte
+# offset reached is kept in a "<segment>.pos" file, so a replay interrupted
+# halfway resumes where it stopped instead of inserting rows twice. A segment
+# is deleted once fully replayed. Any worker may replay any segment it can
+# lock, so segments left behind by a dead worker are picked up too. A record
+# torn by a crash ends its segment; it was never acknowledged anywhere.
+
+import glob
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct(">II")
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"Cannot spool {type(value).__name__}")
+
+
+def _decode(obj):
+    if "$datetime" in obj:
+        return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+def _lock(f):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class LogSpool:
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, replay_batch_size=500):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.replay_batch_size = replay_batch_size
+        self._segment = None
+        self._segment_path = None
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        self._sequence += 1
+        path = os.path.join(self.directory, f"segment-{os.getpid()}-{self._sequence:08d}.log")
+        segment = open(path, "ab")
+        _lock(segment)
+        self._segment, self._segment_path = segment, path
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = self._segment_path = None
+
+    # Append rows and fsync once. Returns False if the rows could not be
+    # written, in which case they are lost.
+    def append(self, rows):
+        records = []
+        for row in rows:
+            payload = json.dumps(list(row), default=_encode).encode("utf-8")
+            records.append(_HEADER.pack(len(payload), zlib.crc32(payload)))
+            records.append(payload)
+        data = b"".join(records)
+        with self._lock:
+            try:
+                # A forked worker must not append to its parent's segment
+                if self._segment is not None and not self._segment_path.startswith(
+                        os.path.join(self.directory, f"segment-{os.getpid()}-")):
+                    self._segment = self._segment_path = None
+                if self._segment is None:
+                    self._open_segment()
+                self._segment.write(data)
+                self._segment.flush()
+                os.fsync(self._segment.fileno())
+                if self._segment.tell() >= self.segment_bytes:
+                    self._close_segment()
+            except OSError as e:
+                logger.error(f"Error spooling {len(rows)} log rows: {e}")
+                self._close_segment()
+                return False
+        metrics.LOG_ROWS_SPOOLED.inc(len(rows))
+        return True
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, "segment-*.log")), key=os.path.getmtime)
+
+    def size(self):
+        total = 0
+        for path in self.segments():
+            try:
+                total += os.path.getsize(path) - self._position(path)
+            except OSError:
+                pass
+        return total
+
+    def _position(self, path):
+        try:
+            with open(f"{path}.pos") as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _save_position(self, path, position):
+        with open(f"{path}.pos.tmp", "w") as f:
+            f.write(str(position))
+        os.replace(f"{path}.pos.tmp", f"{path}.pos")
+
+    # Yields (end offset, rows) per batch, starting at offset
+    def _batches(self, f, offset):
+        f.seek(offset)
+        rows = []
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            length, checksum = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                logger.error(f"Torn record at offset {f.tell() - len(payload) - _HEADER.size} "
+                             f"in {f.name}, skipping the rest of the segment")
+                break
+            rows.append(tuple(json.loads(payload, object_hook=_decode)))
+            if len(rows) >= self.replay_batch_size:
+                yield f.tell(), rows
+                rows = []
+        if rows:
+            yield f.tell(), rows
+
+    # Replay every segment not being written to. Returns the rows replayed;
+    # stops at the first failed insert.
+    def replay(self, insert_rows):
+        with self._replay_lock:
+            # Close our own segment so the rows in it can go too
+            with self._lock:
+                if self._segment is not None and self._segment.tell() > 0:
+                    self._close_segment()
+                active = self._segment_path
+
+            replayed = 0
+            for path in self.segments():
+                if path == active:
+                    continue
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    continue
+                with f:
+                    if not _lock(f):
+                        continue
+                    # Another worker may have finished it before we locked it
+                    if not os.path.exists(path):
+                        continue
+                    for position, rows in self._batches(f, self._position(path)):
+                        if not insert_rows(rows):
+                            return replayed
+                        self._save_position(path, position)
+                        replayed += len(rows)
+                        metrics.LOG_ROWS_REPLAYED.inc(len(rows))
+                    os.remove(path)
+                    try:
+                        os.remove(f"{path}.pos")
+                    except FileNotFoundError:
+                        pass
+                logger.info(f"Replayed spool segment {os.path.basename(path)}")
+            return replayed
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
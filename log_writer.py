@@ -0,0 +1,286 @@
+# Background writer for the MySQL logs table.
+#
+# Request handlers hand rows to LogWriter.submit(), which only appends to an
+# in-memory queue. A single daemon thread drains the queue and writes rows
+# with executemany() (mysql-connector rewrites it into one multi-row INSERT),
+# either once batch_size rows are waiting or flush_interval seconds after the
+# first row of a batch arrived. stop() flushes whatever is still queued.
+#
+# With a LogSpool, batches that cannot be written go to disk instead of
+# being dropped: when the insert fails, for retry_interval seconds after a
+# failure, and whenever spill_backlog rows are queued because MySQL is too
+# slow to keep up. A second thread replays the spool into MySQL every
+# replay_interval seconds. Both run off the request path, so an outage never
+# adds latency to a turn.
+#
+# on_insert, if given, is called with the cursor and the rows after every
+# executemany, inside the same transaction, to keep derived tables in step.
+#
+# A row MySQL rejects (a value too long or of the wrong type) fails its whole
+# batch. Such a batch is retried one row at a time, so only the bad rows are
+# lost: they are appended to the dead_letter file as JSON lines instead of
+# being spooled, where they would block every replay after them. Only a
+# failed connection arms the retry window.
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from mysql.connector import Error, ProgrammingError
+
+import metrics
+from db import release_connection
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+_REJECTED = object()
+
+# Data too long for column, incorrect value for column
+REJECTED_ERRNOS = (1406, 1366)
+
+
+# True when the rows, not the connection, caused the error. A value that
+# cannot be converted fails in the client with a ProgrammingError that has
+# no server error number.
+def is_rejected_row_error(error):
+    if error.errno in REJECTED_ERRNOS:
+        return True
+    return isinstance(error, ProgrammingError) and error.errno in (None, -1)
+
+
+# JSON for the values json cannot encode itself
+def _dead_letter_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return repr(value)
+
+
+class LogWriter:
+    def __init__(self, get_connection, insert_query, batch_size=50, flush_interval=0.5, max_queue=10000,
+                 spool=None, retry_interval=5.0, replay_interval=5.0, spill_backlog=None, on_insert=None,
+                 dead_letter=None):
+        self.get_connection = get_connection
+        self.insert_query = insert_query
+        self.row_width = insert_query.count("%s")
+        self.on_insert = on_insert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.replay_interval = replay_interval
+        self.spill_backlog = spill_backlog if spill_backlog is not None else max_queue // 2
+        self.dead_letter = dead_letter
+        self._dead_letter_lock = threading.Lock()
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._replayer = None
+        self._stopping = threading.Event()
+        self._pid = None
+
+    def start(self):
+        with self._lock:
+            # A forked worker inherits the object but not the thread
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+            self._thread.start()
+            if self.spool is not None:
+                self._stopping = threading.Event()
+                self._replayer = threading.Thread(target=self._replay_periodically, name="log-replayer",
+                                                  daemon=True)
+                self._replayer.start()
+
+    def submit(self, row):
+        if self._thread is None or self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except queue.Full:
+            logger.error(f"Log queue full, dropping log row for uuid={row[0]}")
+            metrics.LOG_ROWS_DROPPED.inc()
+            return False
+
+    # Queue rows that must reach MySQL in the same INSERT
+    def submit_many(self, rows):
+        if not rows:
+            return True
+        if self._thread is None or self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(list(rows))
+            return True
+        except queue.Full:
+            logger.error(f"Log queue full, dropping {len(rows)} log rows")
+            metrics.LOG_ROWS_DROPPED.inc(len(rows))
+            return False
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Log writer did not drain within {timeout}s, {self.queue.qsize()} rows left")
+        if self.spool is not None:
+            self.spool.close()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                if batch:
+                    self._flush_safely(batch)
+                return
+
+            if item is not None:
+                # submit_many() queues a list so its rows share one flush
+                if isinstance(item, list):
+                    batch.extend(item)
+                else:
+                    batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush_safely(batch)
+                batch = []
+                deadline = None
+
+    # An unexpected error (say a bad pool setting) must not end the thread:
+    # submit() would go on queueing rows that nothing writes
+    def _flush_safely(self, batch):
+        try:
+            self._flush(batch)
+        except Exception:
+            logger.exception(f"Unexpected error writing {len(batch)} log rows")
+            self._retry_at = time.monotonic() + self.retry_interval
+            if self.spool is not None:
+                self._spool(batch)
+            else:
+                metrics.LOG_ROWS_DROPPED.inc(len(batch))
+
+    def _flush(self, batch):
+        if self.spool is not None and (time.monotonic() < self._retry_at or self.queue.qsize() >= self.spill_backlog):
+            self._spool(batch)
+            return
+        pending = self._insert(batch)
+        if not pending:
+            return
+        if self.spool is not None:
+            self._spool(pending)
+        else:
+            metrics.LOG_ROWS_DROPPED.inc(len(pending))
+
+    def _spool(self, batch):
+        if self.spool.append(batch):
+            logger.info(f"Spooled {len(batch)} log rows to disk")
+        else:
+            metrics.LOG_ROWS_DROPPED.inc(len(batch))
+
+    def _replay_periodically(self):
+        while not self._stopping.wait(self.replay_interval):
+            if time.monotonic() < self._retry_at:
+                continue
+            try:
+                replayed = self.spool.replay(self._insert_spooled)
+            except OSError as e:
+                logger.error(f"Error replaying log spool: {e}")
+                continue
+            except Exception:
+                logger.exception("Unexpected error replaying log spool")
+                self._retry_at = time.monotonic() + self.retry_interval
+                continue
+            if replayed:
+                logger.info(f"Replayed {replayed} spooled log rows")
+
+    # Rows spooled by an older version lack the columns added since; they
+    # are appended at the end of the row, so pad with NULLs. If the
+    # connection fails partway through a row-by-row retry, the rest is
+    # spooled again so the rows already written are not replayed twice.
+    def _insert_spooled(self, rows):
+        rows = [row + (None,) * (self.row_width - len(row)) for row in rows]
+        pending = self._insert(rows)
+        if pending and len(pending) < len(rows):
+            return self.spool.append(pending)
+        return not pending
+
+    # Write rows; returns the rows that did not reach MySQL because the
+    # connection failed (empty when all were handled). Rows MySQL rejects go
+    # to the dead-letter file.
+    def _insert(self, batch):
+        result = self._write(batch)
+        if result is not _REJECTED:
+            return [] if result else batch
+        if len(batch) > 1:
+            logger.warning(f"MySQL rejected a batch of {len(batch)} log rows, retrying them one at a time")
+        for index, row in enumerate(batch):
+            result = self._write([row])
+            if result is _REJECTED:
+                self._dead_letter(row)
+            elif not result:
+                return batch[index:]
+        return []
+
+    def _dead_letter(self, row):
+        metrics.LOG_ROWS_REJECTED.inc()
+        if self.dead_letter is None:
+            logger.error(f"MySQL rejected log row for uuid={row[0]!r}, dropping it")
+            return
+        logger.error(f"MySQL rejected log row for uuid={row[0]!r}, moving it to {self.dead_letter}")
+        line = json.dumps(list(row), default=_dead_letter_value)
+        try:
+            with self._dead_letter_lock, open(self.dead_letter, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.error(f"Error writing dead-letter log row: {e}")
+
+    # One executemany and commit. Returns True, False when the connection
+    # failed, or _REJECTED when MySQL refused the rows themselves.
+    def _write(self, batch):
+        connection = self.get_connection()
+        if not connection:
+            logger.error(f"No database connection for logging {len(batch)} log rows")
+            self._retry_at = time.monotonic() + self.retry_interval
+            return False
+
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            cursor.executemany(self.insert_query, batch)
+            if self.on_insert is not None:
+                self.on_insert(cursor, batch)
+            connection.commit()
+            logger.info(f"Saved {len(batch)} log rows")
+            metrics.LOG_ROWS_WRITTEN.inc(len(batch))
+            return True
+        except Error as e:
+            logger.error(f"Error saving {len(batch)} log rows: {e}")
+            metrics.DB_ERRORS.labels("write").inc()
+            rejected = is_rejected_row_error(e)
+            if not rejected:
+                self._retry_at = time.monotonic() + self.retry_interval
+            # Don't leave half a batch pending on a pooled connection
+            try:
+                connection.rollback()
+            except Error:
+                pass
+            return _REJECTED if rejected else False
+        finally:
+            release_connection(connection, cursor)
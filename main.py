@@ -1,35 +1,61 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
+from flask_socketio import SocketIO, emit
 from dotenv import load_dotenv
 import os
 import uuid
+import json
+import base64
 import logging
+import time
+import atexit
+import threading
 from datetime import datetime
-import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, pooling
+from db import release_connection
+import metrics
+from log_writer import LogWriter
+from log_spool import LogSpool
+from audio_cache import AudioCache
+from audio_variants import AudioVariants, ORIGINAL
+from session_store import create_session_store
+from campaigns import DNC_INTENTS, CampaignStore
+from stt_pool import RecognizerPool, PoolBusy, RecognitionLate
+from migrations import migrate
+from dnc_registry import DncRegistry, normalize_number
+from request_logging import (configure_logging, parse_endpoint_rules, parse_level, RequestLogger,
+                             DEFAULT_REDACTED_HEADERS, REQUEST_LOGGER)
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
+# Configure logging. Records go through a queue so request threads never
+# wait on the log file or stdout.
 LOG_DIR = "logs"
 os.makedirs(LOG_DIR, exist_ok=True)
 LOG_FILE = os.path.join(LOG_DIR, "app.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ],
-    datefmt='%H:%M %d/%m/%Y'
-)
+log_listener = configure_logging(LOG_FILE, LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
+# Request logging, sampled per endpoint; see README for the rule format
+REQUEST_LOG_SAMPLE_RATE = float(os.getenv("REQUEST_LOG_SAMPLE_RATE", 1.0))
+REQUEST_LOG_LEVEL = parse_level(os.getenv("REQUEST_LOG_LEVEL", "INFO"), "REQUEST_LOG_LEVEL")
+REQUEST_LOG_ENDPOINTS = parse_endpoint_rules(os.getenv("REQUEST_LOG_ENDPOINTS"), REQUEST_LOG_LEVEL)
+REQUEST_LOG_REDACT_HEADERS = os.getenv("REQUEST_LOG_REDACT_HEADERS", ",".join(DEFAULT_REDACTED_HEADERS)).split(",")
+
+request_logger = RequestLogger(logging.getLogger(REQUEST_LOGGER), sample_rate=REQUEST_LOG_SAMPLE_RATE, level=REQUEST_LOG_LEVEL,
+                               endpoint_rules=REQUEST_LOG_ENDPOINTS,
+                               redacted_headers=[header.strip() for header in REQUEST_LOG_REDACT_HEADERS])
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", '123456')
 CORS(app)
+# Per-call channels for the telephony bridge. Handlers for one client run one
+# at a time, in arrival order, so a call's turns cannot overtake each other.
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=os.getenv("SOCKETIO_ASYNC_MODE") or None,
+                    async_handlers=False)
 
 # Configuration
 HOST = os.getenv("HOST", "0.0.0.0")
@@ -41,60 +67,101 @@ MYSQL_USER = os.getenv("MYSQL_USER")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
 MYSQL_DATABASE = os.getenv("MYSQL_DATABASE")
 MYSQL_PORT = int(os.getenv("MYSQL_PORT", 3306))
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 10))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 50))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 0.5))
+LOG_SPOOL_DIR = os.getenv("LOG_SPOOL_DIR", os.path.join(LOG_DIR, "spool"))
+LOG_DEAD_LETTER_PATH = os.getenv("LOG_DEAD_LETTER_PATH", os.path.join(LOG_DIR, "dead_letter.jsonl"))
+LOG_REPLAY_INTERVAL = float(os.getenv("LOG_REPLAY_INTERVAL", 5.0))
+AUDIO_CACHE_MAX_AGE = int(os.getenv("AUDIO_CACHE_MAX_AGE", 86400))
+AUDIO_VARIANTS = [name.strip() for name in os.getenv("AUDIO_VARIANTS", "ulaw_8000,pcm_8000").split(",") if name.strip()]
+AUDIO_VARIANT_DIR = os.getenv("AUDIO_VARIANT_DIR", os.path.join("cache", "audio"))
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", ORIGINAL)
+AUDIO_FFMPEG = os.getenv("AUDIO_FFMPEG", "ffmpeg")
+LOGS_PAGE_SIZE = int(os.getenv("LOGS_PAGE_SIZE", 100))
+LOGS_MAX_PAGE_SIZE = int(os.getenv("LOGS_MAX_PAGE_SIZE", 1000))
+LOGS_STREAM_BATCH_SIZE = 500
+SESSION_TTL = int(os.getenv("SESSION_TTL", 900))
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", 100000))
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+METRICS_DIR = os.getenv("METRICS_DIR")
+BATCH_MAX_TURNS = int(os.getenv("BATCH_MAX_TURNS", 500))
+FUZZY_MATCH_THRESHOLD = os.getenv("FUZZY_MATCH_THRESHOLD", "0.75").lower()
+CAMPAIGNS_DIR = os.getenv("CAMPAIGNS_DIR", "campaigns")
+DEFAULT_CAMPAIGN = os.getenv("DEFAULT_CAMPAIGN", "default")
+CAMPAIGN_RELOAD_INTERVAL = float(os.getenv("CAMPAIGN_RELOAD_INTERVAL", 5.0))
+STT_MODEL_PATH = os.getenv("STT_MODEL_PATH")
+STT_BACKEND = os.getenv("STT_BACKEND", "vosk" if STT_MODEL_PATH else "off").lower()
+STT_WORKERS = int(os.getenv("STT_WORKERS", 2))
+STT_SAMPLE_RATE = int(os.getenv("STT_SAMPLE_RATE", 8000))
+STT_MAX_PENDING = int(os.getenv("STT_MAX_PENDING", 16))
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", 5.0))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+DNC_SNAPSHOT_PATH = os.getenv("DNC_SNAPSHOT_PATH", "dnc.npy")
+DNC_REFRESH_INTERVAL = float(os.getenv("DNC_REFRESH_INTERVAL", 60))
+
+# Validate MySQL configuration before touching anything else. Connections
+# are only made when first needed, so workers start without a DB round trip.
+if not all([MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE]):
+    logger.error("Missing MySQL configuration variables")
+    raise ValueError("MySQL configuration (HOST, USER, PASSWORD, DATABASE) not set")
 
 # Create audio storage directory
 os.makedirs(AUDIO_STORAGE_PATH, exist_ok=True)
 
+# Prompt audio is small and fixed, so it is served from memory
+audio_cache = AudioCache(AUDIO_STORAGE_PATH, max_age=AUDIO_CACHE_MAX_AGE).load()
+
+# Telephony renditions (8 kHz mu-law, PCM, ...) of the prompt audio, built by
+# "python audio_variants.py" at deploy and cached on disk by content hash.
+# Only the cached ones are read here; see audio_variants.py
+audio_variants = AudioVariants(audio_cache, AUDIO_VARIANT_DIR, AUDIO_VARIANTS, ffmpeg=AUDIO_FFMPEG).load()
+if AUDIO_FORMAT not in audio_variants:
+    raise ValueError(f"AUDIO_FORMAT '{AUDIO_FORMAT}' is not mp3 or one of AUDIO_VARIANTS")
+
+# MySQL connection pool, created on first use so a DB outage at import
+# doesn't leave the process without a pool for good
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = pooling.MySQLConnectionPool(
+                    pool_name=f"logs_{os.getpid()}",
+                    pool_size=MYSQL_POOL_SIZE,
+                    pool_reset_session=False,
+                    host=MYSQL_HOST,
+                    user=MYSQL_USER,
+                    password=MYSQL_PASSWORD,
+                    database=MYSQL_DATABASE,
+                    port=MYSQL_PORT
+                )
+    return db_pool
+
 # MySQL connection
 def get_db_connection():
     try:
-        connection = mysql.connector.connect(
-            host=MYSQL_HOST,
-            user=MYSQL_USER,
-            password=MYSQL_PASSWORD,
-            database=MYSQL_DATABASE,
-            port=MYSQL_PORT
-        )
-        return connection
+        return get_db_pool().get_connection()
     except Error as e:
         logger.error(f"Database connection error: {e}")
+        metrics.DB_ERRORS.labels("connect").inc()
         return None
 
-# Initialize database
-def init_db():
+# Apply pending schema migrations; see migrations.py
+def run_migrations():
     connection = get_db_connection()
     if not connection:
-        logger.error("Failed to initialize database - no connection")
+        logger.error("Failed to migrate database - no connection")
         return
-
     try:
-        cursor = connection.cursor()
-        cursor.execute("DROP TABLE IF EXISTS logs")
-        logger.info("Existing logs table dropped")
-
-        create_table_query = """
-        CREATE TABLE logs (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            uuid VARCHAR(36),
-            request_text TEXT,
-            number VARCHAR(20),
-            response_text TEXT,
-            audio_link TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            end TINYINT DEFAULT 0,
-            transfer TINYINT DEFAULT 0
-        )
-        """
-        cursor.execute(create_table_query)
-        connection.commit()
-        logger.info("New logs table created")
-    except Error as e:
-        logger.error(f"Database initialization error: {e}")
+        migrate(connection)
+    except (Error, RuntimeError) as e:
+        logger.error(f"Database migration error: {e}")
     finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+        connection.close()
 
 # Helper function to format timestamp
 def format_timestamp(timestamp):
@@ -103,334 +170,244 @@ def format_timestamp(timestamp):
     return timestamp
 
 # Save log to MySQL
-def save_log_to_db(uuid=None, request_text=None, number=None, response_text=None, audio_link=None, end=0, transfer=0):
-    connection = get_db_connection()
-    if not connection:
-        logger.error("No database connection for logging")
-        return
-
-    try:
-        cursor = connection.cursor()
-        query = """
-        INSERT INTO logs (uuid, request_text, number, response_text, audio_link, created_at, end, transfer)
-        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, %s, %s)
-        """
-        values = (uuid, request_text, number, response_text, audio_link, end, transfer)
-        cursor.execute(query, values)
-        connection.commit()
-        cursor.execute("SELECT created_at FROM logs WHERE id = LAST_INSERT_ID()")
-        created_at = cursor.fetchone()[0]
-        formatted_time = format_timestamp(created_at)
+LOG_INSERT_QUERY = """
+INSERT INTO logs (uuid, request_text, number, response_text, audio_link, created_at, end, transfer, intent)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+# Call-level summaries live in the calls table. They are updated in the same
+# transaction as the log rows they are built from, and all turns of one call
+# in a batch collapse into a single upsert.
+CALL_SUMMARY_UPSERT = """
+INSERT INTO calls (uuid, number, first_at, last_at, turns, intents, end, transfer)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    number = COALESCE(number, VALUES(number)),
+    first_at = LEAST(first_at, VALUES(first_at)),
+    last_at = GREATEST(last_at, VALUES(last_at)),
+    turns = turns + VALUES(turns),
+    intents = CONCAT_WS(',', intents, VALUES(intents)),
+    end = GREATEST(end, VALUES(end)),
+    transfer = GREATEST(transfer, VALUES(transfer))
+"""
+
+# Callers who ask not to be called again are added to the dnc table with the
+# log rows of the turn where they asked. Rows do not name their campaign, so
+# the request text is checked against the DNC phrases of every loaded one.
+DNC_INSERT = "INSERT IGNORE INTO dnc (number, source) VALUES (%s, 'caller')"
+
+def is_dnc_request(text):
+    return any(campaign.is_dnc_request(text) for campaign in campaign_store.campaigns.values())
+
+def record_dnc_requests(cursor, rows):
+    numbers = {normalize_number(row[2]) for row in rows if row[8] in DNC_INTENTS and is_dnc_request(row[1] or "")}
+    numbers.discard(None)
+    if numbers:
+        cursor.executemany(DNC_INSERT, [(number,) for number in numbers])
+
+def update_call_tables(cursor, rows):
+    update_call_summaries(cursor, rows)
+    record_dnc_requests(cursor, rows)
+
+# Rows without an intent never reached the conversation flow (empty input,
+# errors) and are left out of the summary
+def update_call_summaries(cursor, rows):
+    summaries = {}
+    for uuid, _, number, _, _, created_at, end, transfer, intent in rows:
+        if not uuid or intent is None:
+            continue
+        summary = summaries.get(uuid)
+        if summary is None:
+            summaries[uuid] = [uuid, number, created_at, created_at, 1, [intent], end, transfer]
+        else:
+            summary[3] = created_at
+            summary[4] += 1
+            summary[5].append(intent)
+            summary[6] = max(summary[6], end)
+            summary[7] = max(summary[7], transfer)
+    if summaries:
+        cursor.executemany(CALL_SUMMARY_UPSERT, [
+            (uuid, number, first_at, last_at, turns, ",".join(intents), end, transfer)
+            for uuid, number, first_at, last_at, turns, intents, end, transfer in summaries.values()
+        ])
+
+# Rows are queued here and written in batches off the request thread
+# Rows MySQL cannot take right now are spooled to disk and replayed later
+log_spool = LogSpool(LOG_SPOOL_DIR) if LOG_SPOOL_DIR.lower() != "off" else None
+log_writer = LogWriter(get_db_connection, LOG_INSERT_QUERY, batch_size=LOG_BATCH_SIZE,
+                       flush_interval=LOG_FLUSH_INTERVAL, spool=log_spool, retry_interval=LOG_REPLAY_INTERVAL,
+                       replay_interval=LOG_REPLAY_INTERVAL, on_insert=update_call_tables,
+                       dead_letter=LOG_DEAD_LETTER_PATH if LOG_DEAD_LETTER_PATH.lower() != "off" else None)
+atexit.register(log_writer.stop)
+
+def make_log_row(uuid=None, request_text=None, number=None, response_text=None, audio_link=None, end=0, transfer=0,
+                 intent=None):
+    return (uuid, request_text, number, response_text, audio_link, datetime.now(), end, transfer, intent)
+
+def save_log_to_db(uuid=None, request_text=None, number=None, response_text=None, audio_link=None, end=0, transfer=0,
+                   intent=None):
+    values = make_log_row(uuid, request_text, number, response_text, audio_link, end, transfer, intent)
+    if log_writer.submit(values):
         logger.info(
-            f"Log saved: uuid={uuid}, request_text='{request_text}', created_at={formatted_time}, end={end}, transfer={transfer}")
-    except Error as e:
-        logger.error(f"Error saving log: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
-
-# Initialize database
-init_db()
-
-# Validate MySQL configuration
-if not all([MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE]):
-    logger.error("Missing MySQL configuration variables")
-    raise ValueError("MySQL configuration (HOST, USER, PASSWORD, DATABASE) not set")
-
-# Conversation state management
-conversation_states = {}
+            f"Log queued: uuid={uuid}, request_text='{request_text}', created_at={format_timestamp(values[5])}, end={end}, transfer={transfer}")
+
+# Campaign scripts (prompts, intents, audio and flow) live in CAMPAIGNS_DIR
+# and are recompiled when their file changes; see campaigns.py.
+# FUZZY_MATCH_THRESHOLD=off disables the fuzzy fallback.
+campaign_store = CampaignStore(CAMPAIGNS_DIR, audio_cache, f"{BASE_URL}{AUDIO_STORAGE_PATH}",
+                               default=DEFAULT_CAMPAIGN,
+                               fuzzy_threshold=None if FUZZY_MATCH_THRESHOLD == "off" else float(FUZZY_MATCH_THRESHOLD),
+                               reload_interval=CAMPAIGN_RELOAD_INTERVAL, retain=SESSION_TTL,
+                               audio_variants=audio_variants).start()
+
+# Renditions missing from the cache are built in the background; the
+# campaigns are recompiled to point at them once they are served
+audio_variants.start(on_ready=lambda: campaign_store.reload(force=True))
+
+# Offline speech recognition for /process_audio_chunk, off unless configured
+recognizer_pool = None
+if STT_BACKEND != "off":
+    recognizer_pool = RecognizerPool(STT_BACKEND, STT_MODEL_PATH, workers=STT_WORKERS, sample_rate=STT_SAMPLE_RATE,
+                                     max_pending=STT_MAX_PENDING, timeout=STT_TIMEOUT, idle_timeout=SESSION_TTL)
+    recognizer_pool.start()
+    atexit.register(recognizer_pool.stop)
+
+# Conversation state management. Idle calls are expired after SESSION_TTL
+# seconds and the least recently used call is evicted past SESSION_MAX_COUNT.
+# SESSION_BACKEND=sqlite shares state between all workers on the host.
+conversation_states = create_session_store(SESSION_BACKEND, len(campaign_store.get().intents),
+                                           max_size=SESSION_MAX_COUNT, ttl=SESSION_TTL, path=SESSION_DB_PATH)
+
+# Do-not-call registry, checked on the first turn of every call. It starts
+# from a local snapshot and picks up new numbers from MySQL in the background.
+dnc_registry = DncRegistry(get_db_connection, DNC_SNAPSHOT_PATH, refresh_interval=DNC_REFRESH_INTERVAL).start()
+
+# Metric children used on every turn, looked up once
+map_stage = metrics.STAGE_SECONDS.labels("map_user_input")
+state_machine_stage = metrics.STAGE_SECONDS.labels("state_machine")
+turn_stage = metrics.STAGE_SECONDS.labels("conversation_turn")
+save_log_stage = metrics.STAGE_SECONDS.labels("save_log_to_db")
+recognize_stage = metrics.STAGE_SECONDS.labels("recognize")
+request_stage = metrics.STAGE_SECONDS.labels("request")
+turn_outcomes = {outcome: metrics.TURN_OUTCOMES.labels(outcome) for outcome in ("continue", "end", "transfer")}
+
+# A shared session backend reports the same numbers from every worker
+if SESSION_BACKEND == "sqlite":
+    metrics.SESSIONS_LIVE.multiprocess_mode = "max"
+metrics.SESSIONS_LIVE.set_function(lambda: conversation_states.stats()["live_sessions"])
+metrics.SESSIONS_CREATED.set_function(lambda: conversation_states.created)
+metrics.SESSIONS_EXPIRED.set_function(lambda: conversation_states.expired)
+metrics.SESSIONS_EVICTED.set_function(lambda: conversation_states.evicted)
+metrics.LOG_QUEUE_DEPTH.set_function(lambda: log_writer.queue.qsize())
+if log_spool is not None:
+    metrics.LOG_SPOOL_BYTES.set_function(log_spool.size)
+metrics.CALL_CHANNELS.set_function(lambda: len(call_channels))
+if recognizer_pool is not None:
+    metrics.STT_PENDING.set_function(recognizer_pool.pending)
+metrics.DNC_NUMBERS.set_function(lambda: len(dnc_registry))
+if METRICS_DIR:
+    metrics.REGISTRY.enable_multiprocess(METRICS_DIR)
 
 def get_conversation_state(session_uuid):
-    if session_uuid not in conversation_states:
-        conversation_states[session_uuid] = {
-            "step": "greeting",
-            "repeat_count": 0,
-            "last_prompt": "greeting",
-            "last_input": None,
-            "specific_repeat_count": {"who_are_you": 0, "what_did_you_say": 0, "something_different": 0, "not_the_person": 0},
-            "input_counts": {}
-        }
+    conversation_state, created = conversation_states.get(session_uuid)
+    if created:
         logger.info(
-            f"Initialized new conversation state for uuid={session_uuid}, step={conversation_states[session_uuid]['step']}")
-    return conversation_states[session_uuid]
+            f"Initialized new conversation state for uuid={session_uuid}, step={conversation_state.step}")
+    return conversation_state, created
 
 def reset_conversation_state(session_uuid):
-    conversation_states[session_uuid] = {
-        "step": "greeting",
-        "repeat_count": 0,
-        "last_prompt": "greeting",
-        "last_input": None,
-        "specific_repeat_count": {"who_are_you": 0, "what_did_you_say": 0, "something_different": 0, "not_the_person": 0},
-        "input_counts": {}
-    }
+    conversation_states.reset(session_uuid)
     logger.info(f"Reset conversation state for uuid={session_uuid}")
 
-# Input mappings for user input variations
-input_mappings = {
-    "greeting": ["hi", "hello", "start", "begin"],
-    "who_are_you": ["who are you", "who is this", "who's calling", "who are u"],
-    "what_did_you_say": ["what did you say", "repeat", "say again", "what was that", "huh"],
-    "never_owed": ["i have never owed", "never owed", "no debt", "don’t owe", "never had debt", "owe"],
-    "how_did_u_get_number": ["number", "how did u get my number", "where did you get my number",
-                             "how’d you get my phone", "who gave you my number", "where’s my number from"],
-    "on_disability": ["disable", "i am on disability", "on disability", "i’m disabled", "disability benefits"],
-    "social": ["social", "social security", "i am on social security", "on social security", "social benefits"],
-    "not_sure": ["not sure", "i dont know", "don’t know", "unsure", "maybe", "know","i’m not sure", "i’m not sher", "i’m not sho", "ahm not sure", "m’not sure","i’m nah shur", "um not sher", "a’m not shuh", "i’m not shoer", "i’m notchur","ahnah sher", "i have no idea", "i’ve no idea", "i got no idea","i ain’t got no idea", "i havena idea", "i got no idear", "i dun have no idea","i ain’t got a clue", "i g’nno idea", "i h’no idea", "i’nno idea", "no clue","nuh clue", "‘no clue", "no’ clue", "noo clue", "nuh-kloo", "nuh cloo","nuhkluh", "n’ clue", "nuhclue", "kno clue", "beats me", "b’s me", "bees me","beats meh", "beats’m", "b’tz me", "beat’sme", "b’tzmeh", "b’z meh","beatsmee", "b'me", "not certain", "not surrin", "not suttin", "noss’rn","not sur’n", "notsh’n", "naht surrin", "naa sur’n", "nod certain","n’t certain", "notsuh’n", "i’m unsure", "i’m unshur", "um unsure","i’m unsher", "ahm unshurr", "am uhnsure", "i’m ‘nshur", "i’m unshuh","um’nshur", "i’m uhnsur", "i’m shurn’t", "i’m in the dark", "i’m’n the dark","iminna dark", "i’m in th’ dark", "i’m’n duh dark", "um’n the dark","i’m ‘n thuh dark", "ah’m inna dark", "imin dark", "i’m in’dark","m’in the dark", "i haven’t looked into it", "haven’t looked inna it","i hav’n’t looked intuh it", "i ain’t looked into it", "haven’ looked’n’tuh it","i haven’t looked’nit", "i have’ looked in tuh it", "i haven’t lookedin it","i h’nt looked ‘t it", "ahven’t looked’n’tuhit", "i ain’t done that yet","i don’t have that information", "i don’ have that info", "i don’t got that info","i d’n have that ‘nfo", "i don’ have tha’ information", "i d’n’t have that info","i dun have dat info", "i don’ got no info", "i don’t have ‘formation","i d’no that info", "i don’t have it on me", "i haven’t the faintest idea","i haven’t the faintest idear", "i haven’t th’ faintest idea","i haven’t got the faintest idea", "i ain’t got the faintest idea","i havn’t the faintest ideuh", "i haven’t the faint’st idear","i haven’ the faintest idear", "i h’ven’t the faintest idea","i haven’t the faint’est idear", "i haven’t the foggiest", "i’m not aware","i’m not ‘ware", "i’m nah aware", "i’m not a-wurr", "i’m not uh-where","i’m naht aware", "um not ‘ware", "i’m not awair", "i’m not aweh","i’m not aw’r", "m’not aware", "i can’t say", "i can’ say", "i cain’t say","i ken’ say", "i can say", "i can’ tell", "i can’ really say", "i can’ say f’sure", "i c’n’t say", "i c’n say", "i cain say", "it’s unclear to me", "it’s un-clear t’me", "it’s unclear ta me","it’s unclear tuh meh", "s’unclear to me", "iss unclear t’meh","it’s uh-clear tuh me", "it’s unclear d’me", "it unclear to me","it’s un-clear tuh meh", "izz unclear t’me", "don’t have a clue","don’t havva clue", "don’ have a clue", "don’ got a clue", "don’t got no clue","don’ have uh clue", "don’ hav a kloo", "d’n’ have a clue", "don’t got clue","don’t ‘ave a clue", "don’ have nuh clue", "i’m not informed","i’m not ‘nformed", "i’m nah informed", "um not informed","i’m not in-fawmd", "i’m notnformed", "i’m not’nformed", "i’m not up on it","i’m not told", "i’m not been told", "i’m not in the know","your guess is as good as mine", "yer guess is good as mine","yo’ guess is good as mine", "your guess’s good’z mine","yer guess good’s mine", "yuh guess is good as mine", "y’guess’s good as mine","guess good as mine", "yer guess’z good’n mine", "yo guess as good’s mine","ya guess’s good as mine", "haven’t got a clue", "ain’t got a clue","haven’t gotta clue", "hav’na clue", "haven’ got nuh clue", "i haven’t a clue","haven’ got n’ clue", "havn’t got a kloo", "haven’t got no clue","ain’ got a clue", "i’m not positive", "i’m not pawz’tiv", "i’m not pahzuhdiv","i’m not pos’dihv", "i’m not real sure", "i’m not sure ‘bout that","i’m not 100%", "um not positive", "i’m not pos’tive", "i’m not p’sitive","i’ll have to find out", "i’ll hafta find out", "i’ll have da find out","i’ll haf’tuh find out", "i’ll have tuh find out", "i’ll have t’find out","i’ll ‘av ta find out", "ah’ll haft find out", "i’ll ‘ave to find out","i’ll ‘aveta find out", "i’ll ‘ave tuh fine out", "i haven’t been told","i haven’t bin told", "i ain’t been told", "i haven’ been told","i haven’t been tole", "i h’n’t been told", "i haven’t been tol’","i hav’nt bin told", "i haven’t heard", "i h’ven’t been told","i ain’t heard nothin’", "i’m not familiar with that", "i’m not fam’liar with that","i’m not f’milyuh with that", "i’m not familiar wit dat","i’m not ‘miliar with that", "i’m not fuhmilyuh wit that","i’m not femilyer with that", "i’m not familiar wif dat","i’m not familar wit that", "i’m not f’miluh with that","um not familiar with that", "i’m drawing a blank", "i’m drawin’ a blank","i’m draw’n a blank", "i’m draw’na blank", "i’m dron’uh blank","i’m draw’n blank", "i’m drawin’ blank", "i’m drahn a blank", "um drawin’ a blank", "i’m dro’in a blank", "m’drawin’ a blank","that’s beyond me", "that’s b’yawn me", "that’s b’yund me", "thas b’yond me","das b’yawn’d me", "thass bee-yawn me", "that’s b’yond meh","thaz beyond me", "dat’s beyond me", "that’s b’yan’ me", "that’s be’on me","i’m stumped", "i’m stumpt", "i’m stum’d", "um stumped", "i’m stuhmpt","i’mstumped", "i’m all stumped", "i’m totally stumped", "i’m just stumped","i’m stuhmp’d", "m’stumped", "i dunno", "dunno", "i ‘unno", "i ono","ionno", "idano", "ahno", "ina’no", "i dono", "ahdunno", "i’no", "anow","ahno’", "i d’know", "iono", "ain’t know", "d’nno", "dno", "ainno","idn’t know"],
-    "this_is_business": ["business", "this is a business", "business line", "company phone", "not personal"],
-    "what_is_this_about": ["what is this about", "what’s this for", "why are you calling", "what do you want"],
-    "are_you_computer": ["real person", "computer", "are you a computer", "are you a real person", "is this a bot",
-                         "are you ai", "robot"],
-    "do_not_call": ["put","list","put me on your do not call list", "do not call", "don’t call me", "stop calling",
-                    "no calls"],
-    "not_a_problem": ["call","do not call me anymore", "do not call me again", "stop calling me"],
-    "yes": ["yes", "yeah", "yep", "sure", "okay", "ok", "yup", "aye", "affirmative", "certainly", "of course", "definitely", "absolutely", "indeed", "sure thing", "you bet", "for sure", "by all means", "without a doubt", "I agree", "that’s right", "right on", "roger that", "true", "uh-huh", "totally", "okie-dokie", "for real", "probably", "I guess so", "seems like it", "looks that way", "sounds about right", "could be", "I’d say so", "I suppose", "I figure", "most likely", "I reckon", "I believe so", "I assume so", "it seems so", "I would think so", "I’d imagine", "I’d expect so", "as far as I know", "from what I can tell", "it appears that way", "I presume so", "to the best of my knowledge", "evidently", "apparently so", "that seems to be the case", "I do", "no doubt", "yep, absolutely", "you know it", "yep, for sure", "sure enough", "I do indeed", "I certainly do", "most certainly", "I can confirm that","I think so"],
-    "no": ["no", "nope", "not really", "nah", "no way", "nay", "negative", "not at all", "absolutely not", "never", "not quite", "I don’t think so", "I’m afraid not", "regrettably not", "unfortunately not", "by no means", "out of the question", "nothing doing", "not happening", "no can do", "certainly not", "over my dead body", "count me out", "I’ll pass", "no siree", "not in a million years"],
-    "something_else": []
-}
-
-# List of common words to remove
-STOP_WORDS = {}
-
-# Prompts for responses
-PROMPTS = {
-    "greeting": "Hi, my name is Michele with Tax Group. Do you have a tax debt of five thousand dollars or unfiled tax returns? Please answer yes or know or I don’t know",
-    "who_are_you": "Hi, my name is Michele with Tax Group. Do you have a tax debt of five thousand dollars or unfiled tax returns?",
-    "what_did_you_say": "Hi, my name is Michele with Tax Group. Do you have a tax debt of five thousand dollars or unfiled tax returns?",
-    "end_call": "Thank you for your time, unfortunately we are not able to help you at this time.",
-    "transfer": "Please wait and the next available live agent will answer the call.",
-    "never_owed": "We can only help you if you have a tax debt or unfiled tax returns. Thank you for your time. Before I go, are you sure you don’t have a tax debt or unfiled tax returns?",
-    "how_did_u_get_number": "Not sure, but do you have a tax debt of five thousand dollars or unfiled tax returns?",
-    "on_disability": "We can help you. Do you have a tax debt of five thousand dollars or unfiled tax returns?",
-    "social": "We can help you. Do you have a tax debt of five thousand dollars or unfiled tax returns?",
-    "not_sure": "If you’d like to check, I can transfer you to a live agent now. Would you like to see if you have any unresolved tax issues? please answer yes or no only.",
-    "this_is_business": "Certainly, and sorry for the call. But before I go, do you personally have any missed tax filings or owe more than five thousand dollars in taxes?",
-    "what_is_this_about": "We help people with tax debts or past unfiled taxes.",
-    "are_you_computer": "I am an AI Virtual Assistant. Do you personally have any missed tax filings or owe more than five thousand dollars in taxes?",
-    "do_not_call": "I would be happy to do that, but before I go, do you personally have any missed tax filings or owe more than five thousand dollars in taxes?",
-    "not_a_problem": "Not a problem I will put you on our Do Not call list but before I go do you personally have any missed tax filings or owe more than Five Thousand dollars in taxes?",
-    "something_different": "I am sorry I did not understand, Do you personally have any tax filing you have missed or do you owe more than five thousand dollars in taxes? Please answer yes, no or I don’t know only.",
-    "yes": "Ok let me transfer you to a live agent.",
-    "no": "We can only help you if you have a tax debt or unfiled tax returns. Thank you for your time. Before I go, let me ask you one more time, do you owe more than five thousand in back taxes or have any unfiled back taxes? Please answer yes, no or I dont know.",
-    "something_else": "I am sorry I did not understand, Do you personally have any tax filing you have missed or do you owe more than five thousand dollars in taxes? Please answer yes, no or I don’t know only."
-}
-
-# Mapping of response texts to audio filenames
-AUDIO_MAP = {text: f"{key}.mp3" for key, text in PROMPTS.items()}
-
-# Update AUDIO_MAP with existing audio files
-for filename in os.listdir(AUDIO_STORAGE_PATH):
-    if filename.endswith(".mp3"):
-        base_name = filename.replace(".mp3", "").lower()
-        for key, text in PROMPTS.items():
-            if base_name == key.lower():
-                AUDIO_MAP[text] = filename
-                break
-
-def text_to_speech(text):
-    audio_filename = AUDIO_MAP.get(text)
-    if audio_filename and os.path.exists(os.path.join(AUDIO_STORAGE_PATH, audio_filename)):
-        audio_url = f"{BASE_URL}{AUDIO_STORAGE_PATH}{audio_filename}"
-        logger.info(f"Using pre-recorded audio: {audio_url} for text: '{text}'")
-        return audio_url
-    logger.error(f"No pre-recorded audio found for text: '{text}'")
-    return None
-
-# Map user input to a key
-def map_user_input(user_input_lower):
-    # Remove underscores from the input
-    cleaned_input = user_input_lower.replace('_', ' ')
-    words = cleaned_input.split()
-    filtered_words = [word for word in words if word not in STOP_WORDS]
-
-    if not filtered_words:
-        return "something_else"
-
-    filtered_input = " ".join(filtered_words)
-
-    # Check for exact phrase matches first
-    for key, phrases in input_mappings.items():
-        for phrase in phrases:
-            if cleaned_input == phrase:  # Exact match after underscore removal
-                return key
-
-    # Check for filtered input matches
-    for key, phrases in input_mappings.items():
-        for phrase in phrases:
-            phrase_words = phrase.split()
-            filtered_phrase_words = [word for word in phrase_words if word not in STOP_WORDS]
-            filtered_phrase = " ".join(filtered_phrase_words)
-
-            if filtered_input == filtered_phrase:
-                return key
-
-            if filtered_phrase and filtered_phrase in filtered_input:
-                return key
-
-    return "something_else"
-
-# Process user input with interrupt logic for input_mappings
-def process_user_input(user_input, session_uuid, phone_number):
+# Audio format a request asks for: the name it gives, else the first audio
+# type its Accept header prefers, else AUDIO_FORMAT. None for an unknown name,
+# or for a JSON value that is not a string.
+def requested_audio_format(name, accept=None):
+    if name is not None and not isinstance(name, str):
+        return None
+    if name is None and accept is not None:
+        name = audio_variants.negotiate(accept)
+    name = name or AUDIO_FORMAT
+    return name if name in audio_variants else None
+
+# Map user input to a key. The exact/substring matcher is the fast path;
+# only its misses are scored by the fuzzy matcher.
+def map_user_input(campaign, user_input_lower):
+    mapped_input = campaign.intent_matcher.match(user_input_lower)
+    if mapped_input == "something_else" and campaign.fuzzy_matcher is not None:
+        fuzzy_input, score = campaign.fuzzy_matcher.match(user_input_lower)
+        if fuzzy_input:
+            logger.info(f"Fuzzy matched '{user_input_lower}' to '{fuzzy_input}' (score {score:.2f})")
+            metrics.FUZZY_MATCHES.labels(fuzzy_input).inc()
+            return fuzzy_input
+    return mapped_input
+
+# Process user input with interrupt logic for the campaign's intents
+def process_user_input(user_input, session_uuid, phone_number, campaign_name=None):
+    turn, _ = respond_to_user_input(user_input, session_uuid, phone_number, campaign_name)
+    return turn.text, turn.end, turn.transfer
+
+# Same as process_user_input, returning the precomputed TurnResponse and the
+# mapped intent (None when the input never reached the flow)
+def respond_to_user_input(user_input, session_uuid, phone_number, campaign_name=None):
     if not user_input or not session_uuid or not phone_number:
         logger.error("Empty input, uuid, or phone number")
-        return PROMPTS["something_different"], 0, 0
+        return (campaign_store.get(campaign_name) or campaign_store.get()).invalid_input, None
+
+    try:
+        return handle_conversation_turn(user_input, session_uuid, phone_number, campaign_name)
+    finally:
+        # Write the turn's state back for backends shared between workers
+        conversation_states.save(session_uuid)
+
+# Advance the call's state machine; returns (TurnResponse, intent). The call
+# stays on the campaign version its first turn ran on.
+def handle_conversation_turn(user_input, session_uuid, phone_number=None, campaign_name=None):
+    conversation_state, created = get_conversation_state(session_uuid)
+    campaign = campaign_store.for_call(conversation_state, campaign_name)
+    if created and phone_number in dnc_registry:
+        logger.info(f"Ending call for uuid={session_uuid}: {phone_number} is on the do-not-call list")
+        metrics.DNC_BLOCKED.inc()
+        turn_outcomes["end"].inc()
+        reset_conversation_state(session_uuid)
+        return campaign.dnc_blocked, "dnc_listed"
 
-    conversation_state = get_conversation_state(session_uuid)
     user_input_lower = user_input.lower().strip()
-    mapped_input = map_user_input(user_input_lower)
-
-    # Track all input responses
-    conversation_state['input_counts'][mapped_input] = conversation_state['input_counts'].get(mapped_input, 0) + 1
-    # Track specific inputs in specific_repeat_count
-    if mapped_input in conversation_state['specific_repeat_count']:
-        conversation_state['specific_repeat_count'][mapped_input] += 1
-    # End call if any input (except "yes" and "not_sure") is repeated twice
-    if mapped_input not in ["yes", "not_sure"] and conversation_state['input_counts'][mapped_input] >= 2:
+    started = time.perf_counter()
+    mapped_input = map_user_input(campaign, user_input_lower)
+    mapped = time.perf_counter()
+    transition = campaign.flow.advance(conversation_state, mapped_input, user_input_lower)
+    map_stage.observe(mapped - started)
+    state_machine_stage.observe(time.perf_counter() - mapped)
+    metrics.TURNS.labels(mapped_input).inc()
+    turn_outcomes["end" if transition.end else "transfer" if transition.transfer else "continue"].inc()
+
+    if transition.reason == "repeated_input":
         logger.info(f"Ending call for uuid={session_uuid} due to repeated input '{mapped_input}'")
+    elif transition.reason == "silence":
+        logger.info(f"Ending call for uuid={session_uuid} due to repeated silence")
+    elif transition.transfer:
+        logger.info(f"Triggering transfer for uuid={session_uuid}, step={conversation_state.step}")
+    if mapped_input in DNC_INTENTS and campaign.is_dnc_request(user_input_lower) and dnc_registry.add(phone_number):
+        logger.info(f"Added {phone_number} to the do-not-call list for uuid={session_uuid}")
+
+    if transition.end:
         reset_conversation_state(session_uuid)
-        return PROMPTS["end_call"], 1, 0
-    conversation_state['last_input'] = mapped_input
-
-    if user_input_lower in ["", "silence"]:
-        conversation_state['repeat_count'] += 1
-        if conversation_state['repeat_count'] >= 2:
-            logger.info(f"Ending call for uuid={session_uuid} due to repeated silence")
-            reset_conversation_state(session_uuid)
-            return PROMPTS["end_call"], 1, 0
-        return PROMPTS[conversation_state['last_prompt']], 0, 0
-
-    # Handle specific inputs explicitly
-    if mapped_input == "greeting":
-        conversation_state['last_prompt'] = "greeting"
-        conversation_state['step'] = "greeting"
-        return PROMPTS["greeting"], 0, 0
-    elif mapped_input == "who_are_you":
-        conversation_state['last_prompt'] = "who_are_you"
-        return PROMPTS["who_are_you"], 0, 0
-    elif mapped_input == "what_did_you_say":
-        conversation_state['last_prompt'] = "what_did_you_say"
-        return PROMPTS["what_did_you_say"], 0, 0
-    elif mapped_input == "never_owed":
-        conversation_state['last_prompt'] = "never_owed"
-        return PROMPTS["never_owed"], 0, 0
-    elif mapped_input == "how_did_u_get_number":
-        conversation_state['last_prompt'] = "how_did_u_get_number"
-        return PROMPTS["how_did_u_get_number"], 0, 0
-    elif mapped_input == "on_disability":
-        conversation_state['last_prompt'] = "on_disability"
-        return PROMPTS["on_disability"], 0, 0
-    elif mapped_input == "social":
-        conversation_state['last_prompt'] = "social"
-        return PROMPTS["social"], 0, 0
-    elif mapped_input == "not_sure":
-        conversation_state['last_prompt'] = "not_sure"
-        return PROMPTS["not_sure"], 0, 0
-    elif mapped_input == "this_is_business":
-        conversation_state['last_prompt'] = "this_is_business"
-        return PROMPTS["this_is_business"], 0, 0
-    elif mapped_input == "what_is_this_about":
-        conversation_state["last_prompt"] = "what_is_this_about"
-        return PROMPTS["what_is_this_about"], 0, 0
-    elif mapped_input == "are_you_computer":
-        conversation_state['last_prompt'] = "are_you_computer"
-        return PROMPTS["are_you_computer"], 0, 0
-    elif mapped_input == "do_not_call":
-        conversation_state['last_prompt'] = "do_not_call"
-        return PROMPTS["do_not_call"], 0, 0
-    elif mapped_input == "not_a_problem":
-        conversation_state['last_prompt'] = "not_a_problem"
-        return PROMPTS["not_a_problem"], 0, 0
-
-    # Handle conversation steps
-    if conversation_state['step'] == "greeting":
-        if mapped_input == "yes":
-            conversation_state['step'] = "tax_type"
-            conversation_state['last_prompt'] = "yes"
-            logger.info(f"Transitioned to step 'tax_type' for uuid={session_uuid}")
-            return PROMPTS["yes"], 0, 1
-        elif mapped_input == "no":
-            conversation_state['step'] = "confirm_no"
-            conversation_state['last_prompt'] = "no"
-            return PROMPTS["no"], 0, 0
-        else:
-            conversation_state['last_prompt'] = "something_different"
-            return PROMPTS["something_different"], 0, 0
-
-    elif conversation_state['step'] == "offer_transfer":
-        if mapped_input == "yes":
-            conversation_state['step'] = "tax_type"
-            conversation_state['last_prompt'] = "yes"
-            logger.info(f"Transitioned to step 'tax_type' for uuid={session_uuid}")
-            return PROMPTS["yes"], 0, 1
-        elif mapped_input == "no":
-            reset_conversation_state(session_uuid)
-            conversation_state['last_prompt'] = "end_call"
-            return PROMPTS["end_call"], 1, 0
-        else:
-            conversation_state['last_prompt'] = "something_else"
-            return PROMPTS["something_else"], 0, 0
-
-    elif conversation_state['step'] == "tax_type":
-        if mapped_input == "yes":
-            conversation_state['last_prompt'] = "yes"
-            logger.info(f"Triggering transfer for uuid={session_uuid} due to 'yes' in tax_type step")
-            return PROMPTS["yes"], 0, 1
-        elif mapped_input == "no":
-            reset_conversation_state(session_uuid)
-            conversation_state['last_prompt'] = "end_call"
-            return PROMPTS["end_call"], 1, 0
-        else:
-            conversation_state['last_prompt'] = "something_else"
-            return PROMPTS["something_else"], 0, 0
-
-    elif conversation_state['step'] == "confirm_no":
-        if mapped_input == "yes":
-            conversation_state['step'] = "tax_type"
-            conversation_state['last_prompt'] = "yes"
-            logger.info(f"Transitioned to step 'tax_type' for uuid={session_uuid}")
-            return PROMPTS["yes"], 0, 1
-        elif mapped_input == "no":
-            reset_conversation_state(session_uuid)
-            conversation_state['last_prompt'] = "end_call"
-            return PROMPTS["end_call"], 1, 0
-        elif mapped_input == "":
-            conversation_state['repeat_count'] += 1
-            if conversation_state['repeat_count'] >= 2:
-                logger.info(f"Ending call for uuid={session_uuid} due to repeated silence")
-                reset_conversation_state(session_uuid)
-                return PROMPTS["end_call"], 1, 0
-            return PROMPTS[conversation_state['last_prompt']], 0, 0
-        else:
-            conversation_state['last_prompt'] = "something_else"
-            return PROMPTS["something_else"], 0, 0
-
-    conversation_state['last_prompt'] = "something_else"
-    return PROMPTS["something_else"], 0, 0
+    return campaign.responses[transition.key], mapped_input
 
 # Log incoming requests
 @app.before_request
 def log_request():
-    body = None
-    content_type = request.headers.get('Content-Type', '').lower()
-    if 'application/json' in content_type:
-        body = request.get_json(silent=True)
-    elif 'multipart/form-data' in content_type or 'application/x-www-form-urlencoded' in content_type:
-        body = dict(request.form) if request.form else None
-    elif request.data:
-        try:
-            body = request.data.decode('utf-8', errors='ignore')
-        except UnicodeDecodeError:
-            body = "[Binary data]"
-    log_data = {
-        "timestamp": format_timestamp(datetime.utcnow()),
-        "client_ip": request.remote_addr,
-        "method": request.method,
-        "url": request.url,
-        "headers": dict(request.headers),
-        "body": body
-    }
-    logger.info(f"Incoming request: {log_data}")
+    g.request_started = time.perf_counter()
+    request_logger.log(request)
+
+# Count requests and time full /process_text_mp3 turns
+@app.after_request
+def record_request_metrics(response):
+    metrics.HTTP_REQUESTS.labels(request.endpoint, response.status_code).inc()
+    if request.endpoint == 'process_text_mp3' and 'request_started' in g:
+        request_stage.observe(time.perf_counter() - g.request_started)
+    return response
 
 # Process text and generate MP3
 @app.route('/process_text_mp3', methods=['POST'])
@@ -440,10 +417,26 @@ def process_text_mp3():
         if not data or 'text' not in data or 'uuid' not in data or 'number' not in data:
             logger.error("Missing text, uuid, or number in the request")
             return jsonify({'error': 'Missing text, uuid, or number in the request'}), 400
+        if isinstance(data['text'], str):
+            invalid = invalid_call_ids(data['uuid'], data['number'])
+        else:
+            invalid = 'text must be a string'
+        if invalid:
+            logger.error(f"Rejected request: {invalid}")
+            return jsonify({'error': invalid}), 400
 
         user_input = data['text'].strip()
         session_uuid = data['uuid']
         phone_number = data['number']
+        campaign_name = data.get('campaign')
+        if campaign_name is not None and campaign_name not in campaign_store:
+            logger.error(f"Unknown campaign '{campaign_name}' requested")
+            return jsonify({'error': f"Unknown campaign '{campaign_name}'"}), 400
+        audio_format = requested_audio_format(data.get('audio_format') or request.args.get('audio_format'),
+                                              request.accept_mimetypes)
+        if audio_format is None:
+            logger.error("Unknown audio format requested")
+            return jsonify({'error': 'Unknown audio_format'}), 400
 
         if not user_input or not session_uuid or not phone_number:
             logger.error("Empty text, uuid, or phone number provided")
@@ -457,36 +450,15 @@ def process_text_mp3():
             return jsonify({'error': 'Empty text, uuid, or number provided'}), 400
 
         logger.info(f"Processing text input: '{user_input}' from session {session_uuid} with number {phone_number}")
-        response_text, end, transfer = process_user_input(user_input, session_uuid, phone_number)
-        audio_url = text_to_speech(response_text)
+        turn = run_turn(user_input, session_uuid, phone_number, campaign_name, audio_format)
 
-        save_log_to_db(
-            uuid=session_uuid,
-            request_text=user_input,
-            number=phone_number,
-            response_text=response_text,
-            audio_link=audio_url,
-            end=end,
-            transfer=transfer
-        )
-
-        if audio_url is None:
+        if turn.audio_url is None:
             logger.error("Failed to generate audio response")
-            return jsonify({
-                'response': response_text,
-                'end': end,
-                'transfer': transfer,
-                'error': 'Failed to generate audio response'
-            }), 500
+            return turn.to_response()
 
         logger.info(
-            f"Response generated: '{response_text}' with audio_url: {audio_url}, end: {end}, transfer: {transfer}")
-        return jsonify({
-            'response': response_text,
-            'audio_url': audio_url,
-            'end': end,
-            'transfer': transfer
-        })
+            f"Response generated: '{turn.text}' with audio_url: {turn.audio_url}, end: {turn.end}, transfer: {turn.transfer}")
+        return turn.to_response()
     except Exception as e:
         logger.error(f"Error processing text: {e}")
         save_log_to_db(
@@ -500,42 +472,516 @@ def process_text_mp3():
         )
         return jsonify({'error': str(e)}), 500
 
-# Serve audio files
+# Widths of the uuid and number columns of the logs and calls tables. A
+# longer value, or one that is not a string, is refused before it reaches
+# the call state or a log row, which MySQL would reject.
+UUID_MAX_LENGTH = 36
+NUMBER_MAX_LENGTH = 20
+
+# Error message for a bad uuid or number, None if both are usable
+def invalid_call_ids(session_uuid, phone_number):
+    if not isinstance(session_uuid, str) or not isinstance(phone_number, str):
+        return 'uuid and number must be strings'
+    if len(session_uuid) > UUID_MAX_LENGTH:
+        return f'uuid is longer than {UUID_MAX_LENGTH} characters'
+    if len(phone_number) > NUMBER_MAX_LENGTH:
+        return f'number is longer than {NUMBER_MAX_LENGTH} characters'
+    return None
+
+# Run one validated turn and queue its log row
+def run_turn(user_input, session_uuid, phone_number, campaign_name=None, audio_format=ORIGINAL):
+    started = time.perf_counter()
+    turn, intent = respond_to_user_input(user_input, session_uuid, phone_number, campaign_name)
+    turn = turn.in_format(audio_format)
+    saving = time.perf_counter()
+    save_log_to_db(
+        uuid=session_uuid,
+        request_text=user_input,
+        number=phone_number,
+        response_text=turn.text,
+        audio_link=turn.audio_url,
+        end=turn.end,
+        transfer=turn.transfer,
+        intent=intent
+    )
+    turn_stage.observe(saving - started)
+    save_log_stage.observe(time.perf_counter() - saving)
+    return turn
+
+# Process a batch of turns, possibly for many calls, in one request. Turns run
+# in array order, so turns of the same call keep their order, and all log
+# rows are queued together so they reach MySQL in one INSERT.
+@app.route('/process_text_batch', methods=['POST'])
+def process_text_batch():
+    data = request.get_json(silent=True)
+    turns = data.get('turns') if isinstance(data, dict) else data
+    if not isinstance(turns, list):
+        logger.error("Batch request without a list of turns")
+        return jsonify({'error': 'Expected a JSON array of turns or an object with a "turns" array'}), 400
+    if len(turns) > BATCH_MAX_TURNS:
+        logger.error(f"Batch of {len(turns)} turns exceeds BATCH_MAX_TURNS={BATCH_MAX_TURNS}")
+        return jsonify({'error': f'At most {BATCH_MAX_TURNS} turns per batch'}), 413
+
+    audio_format = requested_audio_format(request.args.get('audio_format'), request.accept_mimetypes)
+    if audio_format is None:
+        return jsonify({'error': 'Unknown audio_format'}), 400
+
+    results = []
+    log_rows = []
+    for item in turns:
+        result, log_row = process_batch_turn(item, audio_format)
+        results.append(result)
+        if log_row:
+            log_rows.append(log_row)
+    log_writer.submit_many(log_rows)
+
+    logger.info(f"Processed batch of {len(turns)} turns, {len(log_rows)} log rows queued")
+    return Response(b'{"results":[' + b",".join(results) + b']}\n', mimetype='application/json')
+
+# Returns (result JSON bytes, log row or None) for one batch item. An item's
+# own audio_format overrides the batch's.
+def process_batch_turn(item, audio_format=ORIGINAL):
+    session_uuid = item.get('uuid') if isinstance(item, dict) else None
+    prefix = b'{"uuid":' + json.dumps(session_uuid, separators=(",", ":")).encode() + b','
+
+    def error(message):
+        return prefix + json.dumps({'error': message}, separators=(",", ":"))[1:].encode()
+
+    if not isinstance(item, dict) or 'text' not in item or 'uuid' not in item or 'number' not in item:
+        return error('Missing text, uuid, or number in the request'), None
+    if not isinstance(item['text'], str):
+        return error('text must be a string'), None
+    invalid = invalid_call_ids(session_uuid, item['number'])
+    if invalid:
+        return error(invalid), None
+    campaign_name = item.get('campaign')
+    if campaign_name is not None and campaign_name not in campaign_store:
+        return error(f"Unknown campaign '{campaign_name}'"), None
+    if item.get('audio_format') is not None:
+        audio_format = requested_audio_format(item['audio_format'])
+        if audio_format is None:
+            return error(f"Unknown audio_format '{item['audio_format']}'"), None
+
+    user_input = item['text'].strip()
+    phone_number = item['number']
+    if not user_input or not session_uuid or not phone_number:
+        return error('Empty text, uuid, or number provided'), make_log_row(
+            uuid=session_uuid, request_text=user_input or "Empty input", number=phone_number)
+
+    try:
+        turn, intent = respond_to_user_input(user_input, session_uuid, phone_number, campaign_name)
+    except Exception as e:
+        logger.error(f"Error processing batch turn for uuid={session_uuid}: {e}")
+        return error(str(e)), make_log_row(uuid=session_uuid, request_text=user_input, number=phone_number)
+
+    turn = turn.in_format(audio_format)
+    return prefix + turn.json[1:], make_log_row(
+        session_uuid, user_input, phone_number, turn.text, turn.audio_url, turn.end, turn.transfer, intent)
+
+# Streaming speech-to-text: the bridge posts a call's audio as it arrives, as
+# raw 16-bit mono PCM at STT_SAMPLE_RATE, with final=1 on the chunk that ends
+# an utterance. Until an utterance is finished the answer is the partial
+# hypothesis; the finished one is run as a turn like /process_text_mp3.
+# Recognizer state is held by this process's RecognizerPool, so a call's chunks
+# must all reach this worker.
+@app.route('/process_audio_chunk', methods=['POST'])
+def process_audio_chunk():
+    if recognizer_pool is None:
+        return jsonify({'error': 'Speech recognition is not configured'}), 503
+
+    session_uuid = request.args.get('uuid')
+    phone_number = request.args.get('number')
+    final = request.args.get('final') == '1'
+    campaign_name = request.args.get('campaign')
+    if not session_uuid or not phone_number:
+        logger.error("Missing uuid or number in audio chunk")
+        return jsonify({'error': 'Missing uuid or number in the request'}), 400
+    invalid = invalid_call_ids(session_uuid, phone_number)
+    if invalid:
+        logger.error(f"Rejected audio chunk: {invalid}")
+        return jsonify({'error': invalid}), 400
+    if campaign_name is not None and campaign_name not in campaign_store:
+        logger.error(f"Unknown campaign '{campaign_name}' requested")
+        return jsonify({'error': f"Unknown campaign '{campaign_name}'"}), 400
+    audio_format = requested_audio_format(request.args.get('audio_format'), request.accept_mimetypes)
+    if audio_format is None:
+        return jsonify({'error': 'Unknown audio_format'}), 400
+
+    started = time.perf_counter()
+    try:
+        partial, text = recognizer_pool.feed(session_uuid, request.get_data(), final)
+    except PoolBusy as e:
+        logger.warning(f"Speech recognition busy, rejecting chunk for uuid={session_uuid}: {e}")
+        metrics.STT_REJECTED.inc()
+        response = jsonify({'error': 'Speech recognition is busy, retry shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    except RecognitionLate as e:
+        # The chunk will still be decoded; resending it would decode it twice
+        logger.warning(f"Speech recognition late for uuid={session_uuid}: {e}")
+        return jsonify({'uuid': session_uuid, 'partial': '', 'pending': True}), 202
+    except Exception as e:
+        logger.error(f"Error recognizing audio for uuid={session_uuid}: {e}")
+        return jsonify({'error': str(e)}), 500
+    recognize_stage.observe(time.perf_counter() - started)
+
+    if text is None:
+        return jsonify({'uuid': session_uuid, 'partial': partial})
+
+    # An utterance without words is what the bridge reports as silence
+    user_input = text or "silence"
+    logger.info(f"Recognized '{user_input}' for uuid={session_uuid}")
+    try:
+        turn = run_turn(user_input, session_uuid, phone_number, campaign_name, audio_format)
+    except Exception as e:
+        logger.error(f"Error processing recognized text for uuid={session_uuid}: {e}")
+        save_log_to_db(uuid=session_uuid, request_text=user_input, number=phone_number)
+        return jsonify({'error': str(e)}), 500
+    if turn.end or turn.transfer:
+        recognizer_pool.close(session_uuid)
+    return jsonify(dict(turn.payload, uuid=session_uuid, transcript=user_input)), turn.status
+
+# Socket.IO channel: the bridge opens one connection per call, sends
+# "start_call" with the call's uuid, number and optionally campaign and
+# audio_format, then one "text" event per
+# recognized utterance. Each turn is answered with a "turn" event carrying
+# the same fields as /process_text_mp3; failures are answered with "turn_error".
+call_channels = {}
+
+@socketio.on('connect')
+def channel_connect(auth=None):
+    logger.info(f"Call channel opened: sid={request.sid}")
+
+@socketio.on('disconnect')
+def channel_disconnect(*args):
+    call = call_channels.pop(request.sid, None)
+    logger.info(f"Call channel closed: sid={request.sid}, uuid={call[0] if call else None}")
+
+@socketio.on('start_call')
+def channel_start_call(data):
+    if not isinstance(data, dict) or not data.get('uuid') or not data.get('number'):
+        logger.error("start_call without uuid or number")
+        emit('turn_error', {'error': 'Missing uuid or number in start_call'})
+        return
+    invalid = invalid_call_ids(data['uuid'], data['number'])
+    if invalid:
+        logger.error(f"Rejected start_call: {invalid}")
+        emit('turn_error', {'error': invalid})
+        return
+    campaign_name = data.get('campaign')
+    if campaign_name is not None and campaign_name not in campaign_store:
+        logger.error(f"Unknown campaign '{campaign_name}' in start_call")
+        emit('turn_error', {'uuid': data['uuid'], 'error': f"Unknown campaign '{campaign_name}'"})
+        return
+    audio_format = requested_audio_format(data.get('audio_format'))
+    if audio_format is None:
+        emit('turn_error', {'uuid': data['uuid'], 'error': f"Unknown audio_format '{data['audio_format']}'"})
+        return
+    call_channels[request.sid] = (data['uuid'], data['number'], campaign_name, audio_format)
+    logger.info(f"Call channel bound: sid={request.sid}, uuid={data['uuid']}, number={data['number']}")
+    emit('call_started', {'uuid': data['uuid']})
+
+@socketio.on('text')
+def channel_text(data):
+    call = call_channels.get(request.sid)
+    if call is None:
+        emit('turn_error', {'error': 'Send start_call before text'})
+        return
+    session_uuid, phone_number, campaign_name, audio_format = call
+    text = data.get('text') if isinstance(data, dict) else data
+    if not isinstance(text, str) or not text.strip():
+        logger.error(f"Empty text on call channel for uuid={session_uuid}")
+        save_log_to_db(uuid=session_uuid, request_text="Empty input", number=phone_number)
+        emit('turn_error', {'uuid': session_uuid, 'error': 'Empty text provided'})
+        return
+
+    user_input = text.strip()
+    try:
+        turn = run_turn(user_input, session_uuid, phone_number, campaign_name, audio_format)
+    except Exception as e:
+        logger.error(f"Error processing text on call channel for uuid={session_uuid}: {e}")
+        save_log_to_db(uuid=session_uuid, request_text=user_input, number=phone_number)
+        emit('turn_error', {'uuid': session_uuid, 'error': str(e)})
+        return
+    emit('turn', dict(turn.payload, uuid=session_uuid))
+
+# Partial transcripts leave the call's state alone; the bridge gets the intent
+# they match so far and can start fetching the likely prompt early
+@socketio.on('partial')
+def channel_partial(data):
+    call = call_channels.get(request.sid)
+    text = data.get('text') if isinstance(data, dict) else data
+    if call is None or not isinstance(text, str):
+        return
+    campaign = campaign_store.get(call[2]) or campaign_store.get()
+    emit('partial', {'uuid': call[0], 'intent': campaign.intent_matcher.match(text.lower().strip())})
+
+# Prometheus metrics, merged across workers when METRICS_DIR is set
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.exposition(), content_type=metrics.CONTENT_TYPE)
+
+# Session store counters
+@app.route('/get_session_stats', methods=['GET'])
+def get_session_stats():
+    return jsonify(conversation_states.stats())
+
+# Campaigns live in this worker, and superseded versions still serving calls
+@app.route('/get_campaigns', methods=['GET'])
+def get_campaigns():
+    return jsonify(campaign_store.stats())
+
+# Serve audio files. A telephony rendition can be asked for with ?format= or
+# the Accept header; the MP3 is served when there is none.
 @app.route('/static/audio/<filename>')
 def serve_audio(filename):
-    audio_path = os.path.join(AUDIO_STORAGE_PATH, filename)
-    if not os.path.exists(audio_path):
-        logger.error(f"Audio file not found: {audio_path}")
+    audio = audio_cache.get(filename)
+    if audio is None:
+        logger.error(f"Audio file not found: {filename}")
+        return jsonify({'error': 'Audio file not found'}), 404
+    audio_format = request.args.get('format') or audio_variants.negotiate(request.accept_mimetypes) or ORIGINAL
+    if audio_format not in audio_variants:
+        return jsonify({'error': f"Unknown audio format '{audio_format}'"}), 400
+    if audio_format != ORIGINAL:
+        audio = audio_variants.get(audio_format, filename) or audio
+    logger.info(f"Serving audio file: {audio.filename}")
+    response = audio_cache.response(audio, request)
+    response.vary.add('Accept')
+    return response
+
+# Telephony renditions by path, as returned in audio_url for a non-MP3
+# audio_format, e.g. /static/audio/ulaw_8000/greeting.wav
+@app.route('/static/audio/<audio_format>/<filename>')
+def serve_audio_variant(audio_format, filename):
+    audio = audio_variants.files.get((audio_format, filename))
+    if audio is None:
+        logger.error(f"Audio file not found: {audio_format}/{filename}")
         return jsonify({'error': 'Audio file not found'}), 404
-    logger.info(f"Serving audio file: {audio_path}")
-    return send_file(audio_path, mimetype='audio/mpeg')
+    logger.info(f"Serving audio file: {audio.filename}")
+    return audio_cache.response(audio, request)
 
 # Retrieve logs
+LOG_COLUMNS = "id, uuid, request_text, number, response_text, audio_link, created_at, end, transfer, intent"
+
+def encode_log_cursor(created_at, log_id):
+    raw = f"{created_at.isoformat()}|{log_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_log_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    created_at, log_id = raw.rsplit("|", 1)
+    return datetime.fromisoformat(created_at), int(log_id)
+
+# Build the WHERE clause for /get_logs from query parameters. Every filter
+# is backed by one of the indexes created in migrations.py.
+def build_log_filters(args):
+    clauses = []
+    params = []
+    for column in ("uuid", "number"):
+        value = args.get(column)
+        if value:
+            clauses.append(f"{column} = %s")
+            params.append(value)
+    for name, operator in (("since", ">="), ("until", "<")):
+        value = args.get(name)
+        if value:
+            clauses.append(f"created_at {operator} %s")
+            params.append(datetime.fromisoformat(value))
+    for column in ("end", "transfer"):
+        value = args.get(column)
+        if value:
+            if value not in ("0", "1"):
+                raise ValueError(f"{column} must be 0 or 1")
+            clauses.append(f"{column} = %s")
+            params.append(int(value))
+    cursor = args.get("cursor")
+    if cursor:
+        created_at, log_id = decode_log_cursor(cursor)
+        clauses.append("(created_at < %s OR (created_at = %s AND id < %s))")
+        params.extend([created_at, created_at, log_id])
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+# Stream rows as NDJSON from an unbuffered cursor so memory stays flat. The
+# connection goes back to the pool when the response is closed, which also
+# happens when the client leaves before the first row.
+def stream_logs(connection, query, params):
+    cursors = []
+
+    def generate():
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursors.append(cursor)
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(LOGS_STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+                for log in rows:
+                    log['created_at'] = format_timestamp(log['created_at'])
+                    yield json.dumps(log, ensure_ascii=False) + "\n"
+        except Error as e:
+            logger.error(f"Error streaming logs: {e}")
+            metrics.DB_ERRORS.labels("read").inc()
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.call_on_close(lambda: release_connection(connection, cursors[0] if cursors else None))
+    return response
+
 @app.route('/get_logs', methods=['GET'])
 def get_logs():
+    try:
+        where, params = build_log_filters(request.args)
+        limit = request.args.get("limit", type=int)
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be at least 1")
+        stream = request.args.get("format") == "ndjson"
+        if not stream:
+            limit = min(limit or LOGS_PAGE_SIZE, LOGS_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid filter: {e}"}), 400
+
+    query = f"SELECT {LOG_COLUMNS} FROM logs{where} ORDER BY created_at DESC, id DESC"
+    if limit:
+        # Fetch one extra row to know whether there is a next page
+        query += " LIMIT %s"
+        params.append(limit if stream else limit + 1)
+
     connection = get_db_connection()
     if not connection:
         logger.error("No database connection for retrieving logs")
         return jsonify({'error': 'Database connection failed'}), 500
 
+    if stream:
+        return stream_logs(connection, query, params)
+
+    cursor = None
     try:
         cursor = connection.cursor(dictionary=True)
-        query = "SELECT id, uuid, request_text, number, response_text, audio_link, created_at, end, transfer FROM logs ORDER BY created_at DESC"
-        cursor.execute(query)
+        cursor.execute(query, params)
         logs = cursor.fetchall()
+        next_cursor = None
+        if len(logs) > limit:
+            logs = logs[:limit]
+            next_cursor = encode_log_cursor(logs[-1]['created_at'], logs[-1]['id'])
         for log in logs:
             log['created_at'] = format_timestamp(log['created_at'])
         logger.info(f"Retrieved {len(logs)} logs")
-        return jsonify(logs)
+        response = jsonify(logs)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
     except Error as e:
         logger.error(f"Error retrieving logs: {e}")
+        metrics.DB_ERRORS.labels("read").inc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        release_connection(connection, cursor)
+
+# Call summaries and transcripts
+CALL_COLUMNS = "uuid, number, first_at, last_at, turns, intents, end, transfer"
+
+def call_outcome(end, transfer):
+    if transfer:
+        return "transfer"
+    return "end" if end else "open"
+
+def format_call(call):
+    call['first_at'] = format_timestamp(call['first_at'])
+    call['last_at'] = format_timestamp(call['last_at'])
+    call['intents'] = call['intents'].split(",") if call['intents'] else []
+    call['outcome'] = call_outcome(call['end'], call['transfer'])
+    return call
+
+# One call's summary and its turns, read by primary key and idx_logs_uuid
+@app.route('/get_call_transcript', methods=['GET'])
+def get_call_transcript():
+    session_uuid = request.args.get('uuid')
+    if not session_uuid:
+        return jsonify({'error': 'Missing uuid'}), 400
+
+    connection = get_db_connection()
+    if not connection:
+        logger.error("No database connection for retrieving a call transcript")
+        return jsonify({'error': 'Database connection failed'}), 500
+
+    cursor = None
+    try:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(f"SELECT {CALL_COLUMNS} FROM calls WHERE uuid = %s", (session_uuid,))
+        call = cursor.fetchone()
+        cursor.execute(
+            "SELECT created_at, request_text, intent, response_text, audio_link, end, transfer FROM logs "
+            "WHERE uuid = %s ORDER BY created_at, id LIMIT %s", (session_uuid, LOGS_MAX_PAGE_SIZE))
+        turns = cursor.fetchall()
+        if call is None and not turns:
+            return jsonify({'error': 'Call not found'}), 404
+        for turn in turns:
+            turn['created_at'] = format_timestamp(turn['created_at'])
+        logger.info(f"Retrieved transcript for uuid={session_uuid} with {len(turns)} turns")
+        return jsonify({'call': format_call(call) if call else None, 'turns': turns})
+    except Error as e:
+        logger.error(f"Error retrieving call transcript: {e}")
+        metrics.DB_ERRORS.labels("read").inc()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        release_connection(connection, cursor)
+
+# Outcome counts for calls started in [since, until), from the calls table
+# only. Defaults to today so far.
+@app.route('/get_call_stats', methods=['GET'])
+def get_call_stats():
+    try:
+        now = datetime.now()
+        since = request.args.get('since')
+        until = request.args.get('until')
+        since = datetime.fromisoformat(since) if since else now.replace(hour=0, minute=0, second=0, microsecond=0)
+        until = datetime.fromisoformat(until) if until else now
+    except ValueError as e:
+        return jsonify({'error': f"Invalid filter: {e}"}), 400
+
+    clauses = ["first_at >= %s", "first_at < %s"]
+    params = [since, until]
+    number = request.args.get('number')
+    if number:
+        clauses.append("number = %s")
+        params.append(number)
+
+    connection = get_db_connection()
+    if not connection:
+        logger.error("No database connection for retrieving call stats")
+        return jsonify({'error': 'Database connection failed'}), 500
+
+    cursor = None
+    try:
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT COUNT(*) AS calls, COALESCE(SUM(transfer = 1), 0) AS transfer, "
+            "COALESCE(SUM(transfer = 0 AND end = 1), 0) AS end, COALESCE(SUM(turns), 0) AS turns "
+            f"FROM calls WHERE {' AND '.join(clauses)}", params)
+        row = cursor.fetchone()
+        calls = int(row['calls'])
+        outcomes = {'transfer': int(row['transfer']), 'end': int(row['end'])}
+        outcomes['open'] = calls - outcomes['transfer'] - outcomes['end']
+        return jsonify({
+            'since': since.isoformat(),
+            'until': until.isoformat(),
+            'calls': calls,
+            'outcomes': outcomes,
+            'transfer_rate': outcomes['transfer'] / calls if calls else 0.0,
+            'avg_turns': int(row['turns']) / calls if calls else 0.0,
+        })
+    except Error as e:
+        logger.error(f"Error retrieving call stats: {e}")
+        metrics.DB_ERRORS.labels("read").inc()
         return jsonify({'error': str(e)}), 500
     finally:
-        if cursor:
-            cursor.close()
-        if connection and connection.is_connected():
-            connection.close()
+        release_connection(connection, cursor)
 
 if __name__ == '__main__':
     logger.info(f"Starting Tax Debt Assistant API on {HOST}:{PORT}...")
-    app.run(debug=True, host=HOST, port=PORT)
+    # The development server is a single process, so it can migrate on start;
+    # multi-worker deployments run `python migrations.py` once instead
+    run_migrations()
+    socketio.run(app, debug=True, host=HOST, port=PORT)
@@ -0,0 +1,319 @@
+# In-process metrics exposed in Prometheus text format on /metrics.
+#
+# Counters, gauges and histograms are plain Python objects guarded by a lock
+# each, cheap enough to update on every turn. Under gunicorn every worker has
+# its own registry; when METRICS_DIR is set each worker also writes a
+# snapshot to METRICS_DIR/metrics-<pid>.json every few seconds and /metrics
+# merges all snapshots, so any worker can answer a scrape for the whole host.
+# Counters and histograms are summed across workers; gauges are summed or
+# maxed depending on how they were declared.
+
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def snapshot(self):
+        with self._lock:
+            children = list(self._children.items())
+        return {json.dumps(key): child.value() for key, child in children}
+
+
+class CounterChild:
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        return self._value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class GaugeChild:
+    __slots__ = ("_value", "_func")
+
+    def __init__(self):
+        self._value = 0.0
+        self._func = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, func):
+        self._func = func
+
+    def value(self):
+        if self._func is not None:
+            return float(self._func())
+        return self._value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    # multiprocess_mode is "sum" for per-worker quantities and "max" for
+    # values every worker reports identically (e.g. a shared store's size)
+    def __init__(self, name, documentation, labelnames=(), multiprocess_mode="sum"):
+        super().__init__(name, documentation, labelnames)
+        self.multiprocess_mode = multiprocess_mode
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, func):
+        self.labels().set_function(func)
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "total", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+
+    def time(self):
+        return _Timer(self)
+
+    def value(self):
+        with self._lock:
+            return {"counts": list(self.counts), "sum": self.total}
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self._writer = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    # Share this process's metrics with the other workers through directory
+    def enable_multiprocess(self, directory, interval=5.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        def write_periodically():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot()
+
+        self._writer = threading.Thread(target=write_periodically, name="metrics-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.write_snapshot)
+
+    def write_snapshot(self):
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.error(f"Error writing metrics snapshot: {e}")
+
+    # Returns [(alive, snapshot)]. Counters from exited workers still count;
+    # their gauges are dropped.
+    def _collect(self):
+        if not self.directory:
+            return [(True, self.snapshot())]
+        self.write_snapshot()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            try:
+                with open(path) as f:
+                    snapshots.append((_pid_alive(path), json.load(f)))
+            except (OSError, ValueError) as e:
+                logger.error(f"Error reading metrics snapshot {path}: {e}")
+        return snapshots
+
+    def _merge(self, metric, snapshots):
+        merged = {}
+        for alive, snapshot in snapshots:
+            if metric.kind == "gauge" and not alive:
+                continue
+            for key, value in snapshot.get(metric.name, {}).items():
+                if metric.kind == "histogram":
+                    current = merged.setdefault(key, {"counts": [0] * len(value["counts"]), "sum": 0.0})
+                    current["counts"] = [a + b for a, b in zip(current["counts"], value["counts"])]
+                    current["sum"] += value["sum"]
+                elif metric.kind == "gauge" and metric.multiprocess_mode == "max":
+                    merged[key] = max(merged.get(key, value), value)
+                else:
+                    merged[key] = merged.get(key, 0.0) + value
+        return merged
+
+    def exposition(self):
+        snapshots = self._collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for key, value in sorted(self._merge(metric, snapshots).items()):
+                labels = list(zip(metric.labelnames, json.loads(key)))
+                if metric.kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), value["counts"]):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{metric.name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+                    lines.append(f"{metric.name}_sum{_labels(labels)} {value['sum']}")
+                    lines.append(f"{metric.name}_count{_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{metric.name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(path):
+    try:
+        pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+        os.kill(pid, 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "callagent_stage_seconds", "Time spent in each stage of a /process_text_mp3 turn", ["stage"])
+TURNS = REGISTRY.counter("callagent_turns_total", "Turns handled, by mapped intent", ["intent"])
+FUZZY_MATCHES = REGISTRY.counter("callagent_fuzzy_matches_total", "Inputs mapped by the fuzzy fallback", ["intent"])
+CAMPAIGN_RELOADS = REGISTRY.counter("callagent_campaign_reloads_total", "Campaign files compiled, by result: loaded or error", ["result"])
+TURN_OUTCOMES = REGISTRY.counter(
+    "callagent_turn_outcomes_total", "Turn outcomes: continue, end or transfer", ["outcome"])
+HTTP_REQUESTS = REGISTRY.counter("callagent_http_requests_total", "HTTP requests, by endpoint and status",
+                                 ["endpoint", "status"])
+DB_ERRORS = REGISTRY.counter("callagent_db_errors_total", "MySQL errors, by operation", ["operation"])
+LOG_ROWS_WRITTEN = REGISTRY.counter("callagent_log_rows_written_total", "Log rows written to MySQL")
+LOG_ROWS_DROPPED = REGISTRY.counter("callagent_log_rows_dropped_total", "Log rows dropped before reaching MySQL")
+LOG_ROWS_REJECTED = REGISTRY.counter("callagent_log_rows_rejected_total", "Log rows MySQL refused, moved to the dead-letter file")
+LOG_QUEUE_DEPTH = REGISTRY.gauge("callagent_log_queue_depth", "Log rows waiting for the background writer")
+LOG_ROWS_SPOOLED = REGISTRY.counter("callagent_log_rows_spooled_total", "Log rows spooled to disk while MySQL was unavailable or slow")
+LOG_ROWS_REPLAYED = REGISTRY.counter("callagent_log_rows_replayed_total", "Spooled log rows replayed into MySQL")
+LOG_SPOOL_BYTES = REGISTRY.gauge("callagent_log_spool_bytes", "Bytes of spooled log rows not yet replayed", multiprocess_mode="max")
+CALL_CHANNELS = REGISTRY.gauge("callagent_call_channels", "Calls bound to an open Socket.IO channel")
+STT_PENDING = REGISTRY.gauge("callagent_stt_pending_chunks", "Audio chunks waiting for or in speech recognition")
+STT_REJECTED = REGISTRY.counter("callagent_stt_rejected_total", "Audio chunks rejected because recognition was saturated")
+DNC_BLOCKED = REGISTRY.counter("callagent_dnc_blocked_total", "Calls ended on the first turn because the number is on the do-not-call list")
+DNC_NUMBERS = REGISTRY.gauge("callagent_dnc_numbers", "Numbers in the do-not-call registry", multiprocess_mode="max")
+SESSIONS_LIVE = REGISTRY.gauge("callagent_sessions_live", "Live conversation sessions")
+SESSIONS_CREATED = REGISTRY.gauge("callagent_sessions_created", "Sessions created since start")
+SESSIONS_EXPIRED = REGISTRY.gauge("callagent_sessions_expired", "Sessions expired after the idle TTL since start")
+SESSIONS_EVICTED = REGISTRY.gauge("callagent_sessions_evicted", "Sessions evicted at the size limit since start")
@@ -0,0 +1,173 @@
+# Versioned schema migrations for the MySQL database.
+#
+# Each migration has a version number and a function that moves the schema
+# from the previous version to its own. Applied versions are recorded in
+# schema_migrations and a named MySQL lock serialises concurrent runs, so
+# running migrate() again, or from several hosts at once, only applies what
+# is missing. Migrations add tables, columns and indexes; they never drop
+# data. MySQL commits DDL immediately, so every step checks the live schema
+# before changing it and a run interrupted halfway can simply be repeated.
+# This also lets databases created by the old DROP-and-recreate init_db()
+# migrate cleanly.
+#
+# Run once per deploy, before starting the workers:
+#     python migrations.py
+
+import logging
+import os
+
+import mysql.connector
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = "callagent_schema_migrations"
+LOCK_TIMEOUT = 60
+
+
+def _exists(cursor, query, params):
+    cursor.execute(query, params)
+    return cursor.fetchone()[0] > 0
+
+
+def _column_exists(cursor, table, column):
+    return _exists(cursor, "SELECT COUNT(*) FROM information_schema.columns "
+                           "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+                   (table, column))
+
+
+def _index_exists(cursor, table, index):
+    return _exists(cursor, "SELECT COUNT(*) FROM information_schema.statistics "
+                           "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+                   (table, index))
+
+
+def _add_column(cursor, table, column, definition):
+    if not _column_exists(cursor, table, column):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _add_index(cursor, table, index, columns):
+    if not _index_exists(cursor, table, index):
+        cursor.execute(f"ALTER TABLE {table} ADD INDEX {index} ({columns})")
+
+
+def create_logs_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS logs (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            uuid VARCHAR(36),
+            request_text TEXT,
+            number VARCHAR(20),
+            response_text TEXT,
+            audio_link TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            end TINYINT DEFAULT 0,
+            transfer TINYINT DEFAULT 0
+        )
+    """)
+
+
+def add_logs_indexes(cursor):
+    _add_index(cursor, "logs", "idx_logs_created_at", "created_at, id")
+    _add_index(cursor, "logs", "idx_logs_uuid", "uuid, created_at")
+    _add_index(cursor, "logs", "idx_logs_number", "number, created_at")
+    _add_index(cursor, "logs", "idx_logs_outcome", "end, transfer, created_at")
+
+
+# One row per call, updated with every batch of log rows; see
+# update_call_summaries in main.py
+def add_call_summaries(cursor):
+    _add_column(cursor, "logs", "intent", "VARCHAR(32)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS calls (
+            uuid VARCHAR(36) PRIMARY KEY,
+            number VARCHAR(20),
+            first_at TIMESTAMP NULL DEFAULT NULL,
+            last_at TIMESTAMP NULL DEFAULT NULL,
+            turns INT NOT NULL DEFAULT 0,
+            intents TEXT,
+            end TINYINT DEFAULT 0,
+            transfer TINYINT DEFAULT 0,
+            INDEX idx_calls_first_at (first_at),
+            INDEX idx_calls_number (number, first_at)
+        )
+    """)
+
+
+# Numbers are stored normalised, see dnc_registry.normalize_number
+def create_dnc_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dnc (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            number BIGINT NOT NULL,
+            source VARCHAR(32),
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uniq_dnc_number (number)
+        )
+    """)
+
+
+# Append new migrations at the end; never renumber or edit applied ones
+MIGRATIONS = [
+    (1, "create logs table", create_logs_table),
+    (2, "add logs query indexes", add_logs_indexes),
+    (3, "add logs intent column and calls summary table", add_call_summaries),
+    (4, "create do-not-call table", create_dnc_table),
+]
+
+
+# Apply pending migrations; returns the versions applied
+def migrate(connection, migrations=MIGRATIONS):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError(f"Timed out after {LOCK_TIMEOUT}s waiting for the schema migration lock")
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255),
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cursor.fetchall()}
+
+            newly_applied = []
+            for version, description, apply in migrations:
+                if version in applied:
+                    continue
+                logger.info(f"Applying schema migration {version}: {description}")
+                apply(cursor)
+                cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                               (version, description))
+                connection.commit()
+                newly_applied.append(version)
+            if newly_applied:
+                logger.info(f"Schema migrated to version {newly_applied[-1]}")
+            else:
+                logger.info("Schema is up to date")
+            return newly_applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    connection = mysql.connector.connect(
+        host=os.getenv("MYSQL_HOST"),
+        user=os.getenv("MYSQL_USER"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        database=os.getenv("MYSQL_DATABASE"),
+        port=int(os.getenv("MYSQL_PORT") or 3306),
+    )
+    try:
+        migrate(connection)
+    finally:
+        connection.close()
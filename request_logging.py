@@ -0,0 +1,125 @@
+# Logging setup and the per-request log line.
+#
+# Request threads only put records on a queue; a QueueListener thread does
+# the file and console writes. Request logging is sampled and levelled per
+# endpoint, and each request is written as one JSON object with sensitive
+# headers redacted. Request records go to their own handlers, which write the
+# JSON object alone on its line, without the time and level prefix, so the
+# lines can be fed to a JSON parser as they are.
+
+import atexit
+import json
+import logging
+import queue
+import random
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_DATEFMT = '%H:%M %d/%m/%Y'
+
+REQUEST_LOGGER = "request_log"
+
+DEFAULT_REDACTED_HEADERS = ("authorization", "proxy-authorization", "cookie", "set-cookie", "x-api-key")
+MAX_LOGGED_BODY = 4096
+
+
+def is_request_record(record):
+    return record.name == REQUEST_LOGGER
+
+
+def is_app_record(record):
+    return record.name != REQUEST_LOGGER
+
+
+def configure_logging(log_file, level=logging.INFO):
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+    request_formatter = logging.Formatter('%(message)s')
+    handlers = []
+    for record_filter, handler_formatter in ((is_app_record, formatter), (is_request_record, request_formatter)):
+        for handler in (logging.FileHandler(log_file), logging.StreamHandler()):
+            handler.setFormatter(handler_formatter)
+            handler.addFilter(record_filter)
+            handlers.append(handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    # The queue carries the bare message; the listener's handlers add the prefix
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# Level number for a name such as "info"; getLevelName returns the string
+# "Level X" for a name it does not know
+def parse_level(level_name, setting):
+    level = logging.getLevelName(level_name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level '{level_name}' for {setting}")
+    return level
+
+
+# Parse "endpoint=rate[:LEVEL],..." into {endpoint: (rate, level)}
+def parse_endpoint_rules(spec, default_level):
+    rules = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        endpoint, _, setting = item.partition("=")
+        rate, _, level_name = setting.partition(":")
+        level = parse_level(level_name, f"endpoint '{endpoint}'") if level_name else default_level
+        rules[endpoint.strip()] = (float(rate), level)
+    return rules
+
+
+class RequestLogger:
+    def __init__(self, logger, sample_rate=1.0, level=logging.INFO, endpoint_rules=None,
+                 redacted_headers=DEFAULT_REDACTED_HEADERS):
+        self.logger = logger
+        self.default_rule = (sample_rate, level)
+        self.endpoint_rules = endpoint_rules or {}
+        self.redacted_headers = frozenset(header.lower() for header in redacted_headers)
+
+    # Returns the level to log this request at, or None to skip it
+    def sample(self, endpoint):
+        rate, level = self.endpoint_rules.get(endpoint, self.default_rule)
+        if rate <= 0 or not self.logger.isEnabledFor(level):
+            return None
+        if rate < 1 and random.random() >= rate:
+            return None
+        return level
+
+    def headers(self, headers):
+        return {
+            name: "[REDACTED]" if name.lower() in self.redacted_headers else value
+            for name, value in headers.items()
+        }
+
+    def body(self, request):
+        content_type = request.headers.get('Content-Type', '').lower()
+        if 'application/json' in content_type:
+            return request.get_json(silent=True)
+        if 'multipart/form-data' in content_type or 'application/x-www-form-urlencoded' in content_type:
+            return dict(request.form) if request.form else None
+        if request.data:
+            if content_type.startswith(('audio/', 'application/octet-stream')):
+                return f"[Binary data, {len(request.data)} bytes]"
+            return request.data[:MAX_LOGGED_BODY].decode('utf-8', errors='ignore')
+        return None
+
+    def log(self, request):
+        level = self.sample(request.endpoint)
+        if level is None:
+            return
+        log_data = {
+            "timestamp": datetime.utcnow().strftime(LOG_DATEFMT),
+            "client_ip": request.remote_addr,
+            "method": request.method,
+            "url": request.url,
+            "endpoint": request.endpoint,
+            "headers": self.headers(request.headers),
+            "body": self.body(request),
+        }
+        self.logger.log(level, json.dumps(log_data, ensure_ascii=False, default=str))
@@ -0,0 +1,284 @@
+# Stores for per-call conversation state.
+#
+# Calls that hang up mid-flow never reach reset_conversation_state, so the
+# stores bound themselves two ways: entries idle for longer than ttl seconds
+# are expired, and once max_size entries are live the least recently used one
+# is evicted.
+#
+# Both stores share one interface: get() and reset() hand out a CallState,
+# and save() is called once the turn is done. SessionStore keeps the states
+# in this process, so save() has nothing to do. SqliteSessionStore keeps them
+# in a WAL-mode SQLite file so every gunicorn worker on the host sees the same
+# call state; save() writes the turn's state back.
+
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Compact per-call record. input_counts holds one counter per intent, indexed
+# by the intent's position in the campaign's intents; it grows for campaigns
+# with more intents than intent_count. campaign is the key of the campaign
+# version the call runs on, set on its first turn.
+class CallState:
+    __slots__ = ("step", "repeat_count", "last_prompt", "last_input", "input_counts", "last_seen", "campaign")
+
+    def __init__(self, intent_count):
+        self.step = "greeting"
+        self.repeat_count = 0
+        self.last_prompt = "greeting"
+        self.last_input = None
+        self.input_counts = bytearray(intent_count)
+        self.last_seen = 0.0
+        self.campaign = None
+
+    def count_input(self, intent_index):
+        if intent_index >= len(self.input_counts):
+            self.input_counts.extend(bytes(intent_index + 1 - len(self.input_counts)))
+        count = self.input_counts[intent_index]
+        if count < 255:
+            count += 1
+            self.input_counts[intent_index] = count
+        return count
+
+
+# Process-local store. Entries are kept in an OrderedDict in access order, so
+# the idle ones are always at the front and a sweep only touches expired
+# entries.
+class SessionStore:
+    def __init__(self, intent_count, max_size=100000, ttl=900, clock=time.monotonic):
+        self.intent_count = intent_count
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+
+        sample = CallState(intent_count)
+        self.bytes_per_session = sys.getsizeof(sample) + sys.getsizeof(sample.input_counts)
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, session_uuid):
+        return session_uuid in self._states
+
+    def _expire(self, now):
+        states = self._states
+        cutoff = now - self.ttl
+        while states:
+            session_uuid, state = next(iter(states.items()))
+            if state.last_seen > cutoff:
+                break
+            del states[session_uuid]
+            self.expired += 1
+
+    def _new_state(self, session_uuid, now):
+        states = self._states
+        while len(states) >= self.max_size:
+            states.popitem(last=False)
+            self.evicted += 1
+        state = CallState(self.intent_count)
+        state.last_seen = now
+        states[session_uuid] = state
+        self.created += 1
+        return state
+
+    # Returns (state, created)
+    def get(self, session_uuid):
+        now = self.clock()
+        with self._lock:
+            self._expire(now)
+            state = self._states.get(session_uuid)
+            if state is None:
+                return self._new_state(session_uuid, now), True
+            state.last_seen = now
+            self._states.move_to_end(session_uuid)
+            return state, False
+
+    def reset(self, session_uuid):
+        now = self.clock()
+        with self._lock:
+            self._states.pop(session_uuid, None)
+            return self._new_state(session_uuid, now)
+
+    def save(self, session_uuid):
+        pass
+
+    def discard(self, session_uuid):
+        with self._lock:
+            return self._states.pop(session_uuid, None) is not None
+
+    def stats(self):
+        with self._lock:
+            self._expire(self.clock())
+            live = len(self._states)
+        return {
+            "backend": "memory",
+            "live_sessions": live,
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "bytes_per_session": self.bytes_per_session,
+            "max_sessions": self.max_size,
+            "ttl_seconds": self.ttl,
+        }
+
+
+# Store shared by all processes on the host. Each thread has its own SQLite
+# connection; the states it hands out are remembered per thread until save(),
+# so a state replaced by reset() mid-turn is never written back.
+class SqliteSessionStore:
+    def __init__(self, intent_count, path, max_size=100000, ttl=900, sweep_interval=30, clock=time.time):
+        self.intent_count = intent_count
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._local = threading.local()
+        self._sweep_lock = threading.Lock()
+        self._next_sweep = 0.0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+
+        sample = CallState(intent_count)
+        self.bytes_per_session = sys.getsizeof(sample) + sys.getsizeof(sample.input_counts)
+
+        connection = self._connection()
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                uuid TEXT PRIMARY KEY,
+                step TEXT NOT NULL,
+                repeat_count INTEGER NOT NULL,
+                last_prompt TEXT NOT NULL,
+                last_input TEXT,
+                input_counts BLOB NOT NULL,
+                last_seen REAL NOT NULL,
+                campaign TEXT
+            ) WITHOUT ROWID
+        """)
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(sessions)")}
+        if "campaign" not in columns:
+            connection.execute("ALTER TABLE sessions ADD COLUMN campaign TEXT")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)")
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            local.connection = connection
+            local.pid = os.getpid()
+            local.active = {}
+        return local.connection
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def __contains__(self, session_uuid):
+        row = self._connection().execute(
+            "SELECT 1 FROM sessions WHERE uuid = ? AND last_seen > ?",
+            (session_uuid, self.clock() - self.ttl)).fetchone()
+        return row is not None
+
+    def _sweep(self, connection, now):
+        if now < self._next_sweep or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep = now + self.sweep_interval
+            self.expired += connection.execute(
+                "DELETE FROM sessions WHERE last_seen <= ?", (now - self.ttl,)).rowcount
+            excess = connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_size
+            if excess > 0:
+                self.evicted += connection.execute(
+                    "DELETE FROM sessions WHERE uuid IN "
+                    "(SELECT uuid FROM sessions ORDER BY last_seen LIMIT ?)", (excess,)).rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Session sweep error: {e}")
+        finally:
+            self._sweep_lock.release()
+
+    def _new_state(self, session_uuid, now):
+        state = CallState(self.intent_count)
+        state.last_seen = now
+        self._local.active[session_uuid] = state
+        self.created += 1
+        return state
+
+    # Returns (state, created)
+    def get(self, session_uuid):
+        now = self.clock()
+        connection = self._connection()
+        self._sweep(connection, now)
+        row = connection.execute(
+            "SELECT step, repeat_count, last_prompt, last_input, input_counts, last_seen, campaign "
+            "FROM sessions WHERE uuid = ?", (session_uuid,)).fetchone()
+        if row is None or row[5] <= now - self.ttl:
+            if row is not None:
+                self.expired += 1
+            return self._new_state(session_uuid, now), True
+
+        state = CallState(self.intent_count)
+        state.step, state.repeat_count, state.last_prompt, state.last_input = row[:4]
+        state.input_counts[:len(row[4])] = row[4]
+        state.last_seen = now
+        state.campaign = row[6]
+        self._local.active[session_uuid] = state
+        return state, False
+
+    def reset(self, session_uuid):
+        return self._new_state(session_uuid, self.clock())
+
+    def save(self, session_uuid):
+        state = self._local.active.pop(session_uuid, None) if hasattr(self._local, "active") else None
+        if state is None:
+            return
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions "
+            "(uuid, step, repeat_count, last_prompt, last_input, input_counts, last_seen, campaign) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (session_uuid, state.step, state.repeat_count, state.last_prompt, state.last_input,
+             bytes(state.input_counts), state.last_seen, state.campaign))
+
+    def discard(self, session_uuid):
+        connection = self._connection()
+        self._local.active.pop(session_uuid, None)
+        return connection.execute("DELETE FROM sessions WHERE uuid = ?", (session_uuid,)).rowcount > 0
+
+    def stats(self):
+        connection = self._connection()
+        live = connection.execute(
+            "SELECT COUNT(*) FROM sessions WHERE last_seen > ?", (self.clock() - self.ttl,)).fetchone()[0]
+        page_count = connection.execute("PRAGMA page_count").fetchone()[0]
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "live_sessions": live,
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "bytes_per_session": self.bytes_per_session,
+            "db_bytes": page_count * page_size,
+            "max_sessions": self.max_size,
+            "ttl_seconds": self.ttl,
+        }
+
+
+def create_session_store(backend, intent_count, max_size, ttl, path=None):
+    if backend == "memory":
+        return SessionStore(intent_count, max_size=max_size, ttl=ttl)
+    if backend == "sqlite":
+        return SqliteSessionStore(intent_count, path, max_size=max_size, ttl=ttl)
+    raise ValueError(f"Unknown session backend: {backend}")
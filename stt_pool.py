@@ -0,0 +1,267 @@
+# Offline speech recognition for /process_audio_chunk.
+#
+# Decoding runs in worker processes, so it never competes with the request
+# threads for the GIL. Each worker loads the model once, in its initializer,
+# and keeps one recognizer per call. A call's audio must reach the recognizer
+# that heard its earlier chunks, so every worker is its own single-process
+# executor and a call is pinned to one by a hash of its uuid; the chunks of a
+# call are decoded in the order they were submitted.
+#
+# The pool lives in one web server process. Under gunicorn every worker has
+# its own, so all chunks of a call must be sent to the same gunicorn worker:
+# run with -w 1 or route /process_audio_chunk by uuid (see the README).
+#
+# Each worker accepts at most max_pending chunks at a time. Past that, feed()
+# raises PoolBusy at once instead of queueing, so the caller can answer 503
+# and the bridge can back off and resend.
+#
+# A chunk whose result is not back within timeout seconds is cancelled if no
+# worker has started on it yet, and feed() raises PoolBusy: resending it is
+# safe. A chunk a worker already has cannot be taken back and would be
+# decoded twice if resent, so feed() raises RecognitionLate instead and the
+# text it yields is returned with the call's next chunk.
+#
+# Backend "vosk" needs the vosk package and a model directory. Backend "stub"
+# needs neither: it treats every chunk as UTF-8 text, for tests.
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+BACKENDS = ("vosk", "stub")
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class RecognitionLate(Exception):
+    pass
+
+
+class StubRecognizer:
+    def __init__(self):
+        self.parts = []
+
+    def AcceptWaveform(self, data):
+        self.parts.append(data.decode("utf-8", "replace"))
+        return False
+
+    def PartialResult(self):
+        return json.dumps({"partial": "".join(self.parts).strip()})
+
+    def FinalResult(self):
+        text = "".join(self.parts).strip()
+        self.parts = []
+        return json.dumps({"text": text})
+
+    Result = FinalResult
+
+
+# State of one worker process
+_backend = None
+_model = None
+_sample_rate = None
+_idle_timeout = None
+_recognizers = {}
+_last_sweep = 0.0
+
+
+def _init_worker(backend, model_path, sample_rate, idle_timeout):
+    global _backend, _model, _sample_rate, _idle_timeout
+    _backend = backend
+    _sample_rate = sample_rate
+    _idle_timeout = idle_timeout
+    if backend == "vosk":
+        import vosk
+        vosk.SetLogLevel(-1)
+        _model = vosk.Model(model_path)
+
+
+def _recognizer(call_id, now):
+    entry = _recognizers.get(call_id)
+    if entry is None:
+        if _backend == "vosk":
+            import vosk
+            recognizer = vosk.KaldiRecognizer(_model, _sample_rate)
+        else:
+            recognizer = StubRecognizer()
+        entry = _recognizers[call_id] = [recognizer, now]
+    entry[1] = now
+    return entry[0]
+
+
+# Drop recognizers of calls that stopped sending audio without ending
+def _sweep(now):
+    global _last_sweep
+    if now - _last_sweep < _idle_timeout / 10:
+        return
+    _last_sweep = now
+    for call_id in [call_id for call_id, (_, seen) in _recognizers.items() if now - seen > _idle_timeout]:
+        del _recognizers[call_id]
+
+
+# Returns (partial, text): text is the finished utterance, or None while the
+# speaker is still talking
+def _feed(call_id, chunk, final):
+    now = time.monotonic()
+    _sweep(now)
+    recognizer = _recognizer(call_id, now)
+    text = None
+    if chunk and recognizer.AcceptWaveform(chunk):
+        text = json.loads(recognizer.Result())["text"]
+    if final:
+        rest = json.loads(recognizer.FinalResult())["text"]
+        text = " ".join(part for part in (text, rest) if part)
+    if text is not None:
+        return "", text
+    return json.loads(recognizer.PartialResult())["partial"], None
+
+
+def _close(call_id):
+    _recognizers.pop(call_id, None)
+
+
+# spawn and forkserver would re-run the app's main script in every worker.
+# Forked workers only run this module's functions and never log, so the locks
+# other threads may hold at fork time are never touched in the child.
+def _context():
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("spawn")
+
+
+class RecognizerPool:
+    def __init__(self, backend, model_path=None, workers=2, sample_rate=8000, max_pending=16, timeout=5.0,
+                 idle_timeout=300.0):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown speech recognition backend '{backend}'")
+        if backend == "vosk" and not (model_path and os.path.isdir(model_path)):
+            raise ValueError(f"Speech recognition model directory not found: {model_path}")
+        self.backend = backend
+        self.model_path = model_path
+        self.workers = workers
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._executors = None
+        self._pending = [0] * workers
+        # call_id -> (futures of chunks that timed out once running, last timeout)
+        self._late = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    # Starts the workers, which begin loading the model right away
+    def start(self):
+        with self._lock:
+            # A forked worker inherits the object but not the processes
+            if self._executors is not None and self._pid == os.getpid():
+                return self._executors
+            context = _context()
+            initargs = (self.backend, self.model_path, self.sample_rate, self.idle_timeout)
+            self._executors = [
+                ProcessPoolExecutor(1, mp_context=context, initializer=_init_worker, initargs=initargs)
+                for _ in range(self.workers)
+            ]
+            if self._pid != os.getpid():
+                self._pending = [0] * self.workers
+                self._late = {}
+            self._pid = os.getpid()
+            for executor in self._executors:
+                executor.submit(_close, None)
+            return self._executors
+
+    def _executor(self, index):
+        executors = self._executors
+        if executors is None or self._pid != os.getpid():
+            executors = self.start()
+        return executors[index]
+
+    def _shard(self, call_id):
+        return zlib.crc32(call_id.encode("utf-8")) % self.workers
+
+    def _release(self, index):
+        with self._lock:
+            self._pending[index] -= 1
+
+    def pending(self):
+        return sum(self._pending)
+
+    # Feed one chunk of 16-bit mono PCM for call_id. final marks the end of an
+    # utterance. Returns (partial, text) as _feed() does.
+    def feed(self, call_id, chunk, final=False):
+        index = self._shard(call_id)
+        executor = self._executor(index)
+        with self._lock:
+            if self._pending[index] >= self.max_pending:
+                raise PoolBusy(f"Recognizer worker {index} already has {self.max_pending} chunks pending")
+            self._pending[index] += 1
+        try:
+            future = executor.submit(_feed, call_id, chunk, final)
+        except BrokenProcessPool:
+            self._release(index)
+            self._reset()
+            raise
+        future.add_done_callback(lambda _: self._release(index))
+        try:
+            partial, text = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            if future.cancel():
+                raise PoolBusy(f"Recognizer worker {index} did not start the chunk within {self.timeout}s")
+            self._add_late(call_id, future)
+            raise RecognitionLate(f"Recognizer worker {index} took over {self.timeout}s on the chunk")
+        except BrokenProcessPool:
+            self._reset()
+            raise
+        return self._with_late(call_id, partial, text)
+
+    def _add_late(self, call_id, future):
+        now = time.monotonic()
+        with self._lock:
+            # Forget calls that never sent another chunk
+            self._late = {key: entry for key, entry in self._late.items() if now - entry[1] <= self.idle_timeout}
+            futures = self._late[call_id][0] if call_id in self._late else []
+            self._late[call_id] = (futures + [future], now)
+
+    # Prepend the text of earlier chunks that timed out. A call's chunks are
+    # decoded in order, so they are done by the time a later one is.
+    def _with_late(self, call_id, partial, text):
+        with self._lock:
+            entry = self._late.pop(call_id, None)
+        if entry is None:
+            return partial, text
+        parts = [future.result()[1] for future in entry[0] if future.exception() is None]
+        parts = [part for part in parts if part is not None]
+        if not parts:
+            return partial, text
+        return partial, " ".join(part for part in parts + [text] if part)
+
+    # Forget a call's recognizer once the call is over
+    def close(self, call_id):
+        with self._lock:
+            self._late.pop(call_id, None)
+        try:
+            self._executor(self._shard(call_id)).submit(_close, call_id)
+        except BrokenProcessPool:
+            self._reset()
+
+    # A worker died (e.g. the model failed to load); start fresh ones on the
+    # next chunk
+    def _reset(self):
+        with self._lock:
+            executors, self._executors = self._executors, None
+        for executor in executors or ():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        with self._lock:
+            executors, self._executors = self._executors, None
+        if executors is not None and self._pid == os.getpid():
+            for executor in executors:
+                executor.shutdown(wait=True, cancel_futures=True)
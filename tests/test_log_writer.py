@@ -0,0 +1,185 @@
+# Outage recovery of the log writer against a stand-in for
+# mysql.connector's MySQLConnectionPool. Like the real pool, it hands out a
+# fixed number of connections, raises "pool exhausted" once they are all
+# borrowed, and reconnects a dead connection the next time it is handed out.
+#
+# Run from the repository root:
+#     python -m pytest tests
+
+import os
+import queue
+import sys
+import time
+
+from mysql.connector import Error, InterfaceError, OperationalError, PoolError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from log_spool import LogSpool
+from log_writer import LogWriter
+
+INSERT_QUERY = "INSERT INTO logs (uuid, request_text) VALUES (%s, %s)"
+
+
+class Server:
+    def __init__(self):
+        self.up = True
+        self.rows = []
+
+
+class RawCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def executemany(self, query, rows):
+        if not self.connection.server.up:
+            self.connection.connected = False
+            raise OperationalError(msg="Lost connection to MySQL server during query", errno=2013)
+        self.rows.extend(rows)
+
+    def close(self):
+        pass
+
+
+class RawConnection:
+    unread_result = False
+
+    def __init__(self, server):
+        self.server = server
+        self.connected = True
+        self._cursor = None
+
+    def reconnect(self):
+        if not self.server.up:
+            raise InterfaceError(msg="Can't connect to MySQL server", errno=2003)
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def cursor(self):
+        self._cursor = RawCursor(self)
+        return self._cursor
+
+    def commit(self):
+        if not self.connected:
+            raise OperationalError(msg="MySQL Connection not available", errno=2013)
+        self.server.rows.extend(self._cursor.rows)
+
+    def rollback(self):
+        if not self.connected:
+            raise OperationalError(msg="MySQL Connection not available", errno=2013)
+
+    def consume_results(self):
+        pass
+
+
+class PooledConnection:
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def close(self):
+        self.pool.connections.put_nowait(self.connection)
+        self.connection = None
+
+
+class Pool:
+    def __init__(self, server, size):
+        self.connections = queue.Queue(size)
+        for _ in range(size):
+            self.connections.put(RawConnection(server))
+
+    def get_connection(self):
+        try:
+            connection = self.connections.get_nowait()
+        except queue.Empty:
+            raise PoolError("Failed getting connection; pool exhausted")
+        if not connection.is_connected():
+            try:
+                connection.reconnect()
+            except InterfaceError:
+                self.connections.put_nowait(connection)
+                raise
+        return PooledConnection(self, connection)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_spool_drains_after_outage_longer_than_pool(tmp_path):
+    server = Server()
+    pool = Pool(server, size=2)
+
+    def get_connection():
+        try:
+            return pool.get_connection()
+        except Error:
+            return None
+
+    spool = LogSpool(str(tmp_path / "spool"))
+    writer = LogWriter(get_connection, INSERT_QUERY, batch_size=1, flush_interval=0.01, spool=spool,
+                       retry_interval=0.02, replay_interval=0.02)
+    writer.start()
+    try:
+        writer.submit(("before", "hello"))
+        assert wait_for(lambda: len(server.rows) == 1)
+
+        # Many more failed attempts than the pool has connections
+        server.up = False
+        for i in range(10):
+            writer.submit((f"outage-{i}", "hello"))
+            time.sleep(0.03)
+        assert wait_for(lambda: writer.queue.empty() and spool.size() > 0)
+        assert pool.connections.full()
+
+        server.up = True
+        writer.submit(("after", "hello"))
+        assert wait_for(lambda: len(server.rows) == 12 and spool.size() == 0)
+    finally:
+        writer.stop()
+
+    assert sorted(uuid for uuid, _ in server.rows) == sorted(
+        ["before", "after"] + [f"outage-{i}" for i in range(10)])
+    assert pool.connections.full()
+
+
+def test_writer_survives_unexpected_errors(tmp_path):
+    server = Server()
+    pool = Pool(server, size=2)
+    broken = [True]
+
+    # mysql.connector raises AttributeError, not an Error, for a pool_size
+    # above its maximum
+    def get_connection():
+        if broken[0]:
+            raise AttributeError("Pool size should be higher than 0 and lower or equal to 32")
+        return pool.get_connection()
+
+    spool = LogSpool(str(tmp_path / "spool"))
+    writer = LogWriter(get_connection, INSERT_QUERY, batch_size=1, flush_interval=0.01, spool=spool,
+                       retry_interval=0.02, replay_interval=0.02)
+    writer.start()
+    try:
+        for i in range(3):
+            writer.submit((f"broken-{i}", "hello"))
+        assert wait_for(lambda: writer.queue.empty() and spool.size() > 0)
+        assert writer._thread.is_alive() and writer._replayer.is_alive()
+
+        broken[0] = False
+        writer.submit(("fixed", "hello"))
+        assert wait_for(lambda: len(server.rows) == 4 and spool.size() == 0)
+    finally:
+        writer.stop()